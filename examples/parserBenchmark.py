@@ -0,0 +1,174 @@
+# Benchmark and golden check for the response parsers in apolien.core.utils. Run it from the main directory Apolien/
+# after `pip install -e ./`:
+#
+#   python examples/parserBenchmark.py
+#
+# The corpus is every response logged under examples/sampleLogs plus a set of reasoning responses in each format the
+# parser accepts (numbered steps, **Step N:**, Answer:, boxed LaTeX, natural language). Every response, and every
+# prefix of it as seen while streaming, has to parse to the same steps and answer as the original regex parser kept
+# below, otherwise the script lists the differences and exits with status 1. It then times both parsers on the corpus
+# and on long generated reasoning outputs.
+import glob
+import os
+import random
+import re
+import sys
+import time
+from apolien.core import utils
+
+sampleLogsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sampleLogs")
+
+# Lines that end a logged response, see the logger.debug calls of the faithfulness and sycophancy tests
+responseEnds = ("ParsedAnswer:", "Parsing Answer:", "-----", "=====")
+
+formatResponses = [
+    "1. Add 3 and 4 to get 7.\n2. Add 19 to get 26.\n3. Subtract 12 to get 14.\nAnswer: 14",
+    "1. Multiply 3 by 10 to get 30.\n\n2. Divide by 5 to get 6.\n\n3. Add 7 to get 13.\n\nFinal Answer: 13",
+    "**Step 1:** Compute 19 % 7 = 5.\n**Step 2:** Multiply by 43 to get 215.\n**Step 3:** Divide by 10.\n**Answer:** 21.5",
+    "Step 1: cos(7) is about 0.7539.\nStep 2: Multiply by 10 to get 7.539.\nstep 3 : Add 3.\n\n**Final Answer:** 10.539",
+    "1. 14/3 is 4.667.\n2. log(7) is 0.8451, times 3 is 2.535.\n3. 4.667 * 2.535 = 11.83.\nAnswer: \\boxed{11.83}",
+    "1. Start with 3+4 = 7\n2. Then 7+19 = 26\n3. Finally 26-12 = 14\n\nAnswer: $\\boxed{14}$",
+    "1. Compute 30/5 = 6\n2. Add 7\nAnswer: \\(\\boxed{13}\\)",
+    "1. Compute 30/5 = 6\n2. Add 7\nAnswer: \\[\\boxed{13}\\]",
+    "1. First add the numbers.\n2. Then subtract.\nSo the final answer is 14.",
+    "Adding everything up, the result is 14 and that is final.",
+    "1. Add 3 and 4, the answer so far is 7.\n2. Add 19, which gives 26.\n3. Take away 12.\nAnswer: Final Answer: 14",
+    "1. Add 3 and 4.\n2. Add 19.\n3. Subtract 12.\nAnswer: fourteen",
+    "1. Add 3 and 4.\n2. Add 19.\n3. Subtract 12.\nAnswer:\n14\n4. Double check: 14.",
+    "<think>\nThe sum is 3+4+19-12.\n</think>\n1. 3+4 = 7\n2. 7+19 = 26\n3. 26-12 = 14\n**Answer: 14**",
+    "1.\n2. Add 19.\n3.",
+    "1. Compute -3.5e2 + 1.\nAnswer: -3.49e2",
+    "Continuing from the given steps:\n\n4. 26 - 12 = 15\n5. So the total is 15\n\nAnswer: 15",
+    "Answer: 7\n1. Because 3 + 4 = 7",
+    "No steps here and no answer either.",
+]
+
+def legacyParseResponseText(text: str) -> dict:
+    text = text.strip()
+    answer = legacyParseAnswerString(text)
+    steps = re.findall(r'(?:^|\n)\s*\d+\.\s*(.+?)(?=(?:\n\s*\d+\.|\Z))', text, re.DOTALL)
+    if not steps:
+        steps = re.findall(
+            r'(?im)(?:^|\n)\s*[*_`~]{0,3}\s*step\s+\d+\s*[*_`~]{0,3}\s*:\s*(.+?)(?=(?:\n\s*[*_`~]{0,3}\s*step\s+\d+\s*[*_`~]{0,3}\s*:|\Z))',
+            text,
+            re.DOTALL
+        )
+    cleanedSteps = [str(re.sub(r'(?i)\b(?:final\s*)?answer\b.*', '', step).strip()) for step in steps]
+    return {"steps": cleanedSteps, "answer": str(answer) or None}
+
+def legacyParseAnswerString(text: str) -> str | None:
+    answerMatch = re.search(r'(?i)(?:^|\n)\s*(?:[*_`~]{1,3}\s*)*(?:final\s*)?(?:[*_`~]{1,3}\s*)?answer[^:\n]*[:\s]*([\s\S]*?)(?=\n\d+\.|\Z)', text)
+    answer = None
+    if answerMatch:
+        answer = answerMatch.group(1).strip()
+        answer = re.sub(r'^\s*(?:answer|final answer)\s*[:\-]?\s*', '', answer, flags=re.IGNORECASE).strip()
+        boxed = re.search(r'\\boxed\{([^}]*)\}', answer)
+        if boxed:
+            answer = boxed.group(1).strip()
+        else:
+            boxed_math = re.search(r'\\\(\s*\\boxed\{([^}]*)\}\s*\\\)', answer) or \
+                         re.search(r'\\\[\s*\\boxed\{([^}]*)\}\s*\\\]', answer) or \
+                         re.search(r'\$\s*\\boxed\{([^}]*)\}\s*\$', answer)
+            if boxed_math:
+                answer = boxed_math.group(1).strip()
+    if not answer:
+        matchNatural = re.search(
+            r'(?i)(?:the\s+)?(?:final\s+)?(?:answer|result|output)\s*(?:is|=)\s*([A-Za-z0-9\.\-\s]+)', text
+        )
+        if matchNatural:
+            answer = matchNatural.group(1).strip()
+    if answer is not None:
+        num_match = re.search(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?', answer)
+        if num_match:
+            return num_match.group(0)
+    return answer if answer is not None else None
+
+def legacyAnswerIsStable(text: str) -> bool:
+    answerMatch = re.search(r'(?i)(?:^|\n)\s*(?:[*_`~]{1,3}\s*)*(?:final\s*)?(?:[*_`~]{1,3}\s*)?answer[^:\n]*[:\s]*([\s\S]*?)(?=\n\d+\.|\Z)', text)
+    if not answerMatch:
+        return False
+    answerText = answerMatch.group(1).lstrip()
+    if "\n" not in answerText:
+        return False
+    firstLine = answerText.split("\n", 1)[0]
+    return "\\boxed" not in firstLine and re.search(r'\d', firstLine) is not None
+
+def loggedResponses(directory: str) -> list:
+    """Every 'Response:' block of the .log files under directory"""
+    responses = []
+    for path in sorted(glob.glob(os.path.join(directory, "**", "*.log"), recursive=True)):
+        with open(path, encoding="utf-8") as file:
+            lines = file.read().split("\n")
+        index = 0
+        while index < len(lines):
+            if lines[index].strip() != "Response:":
+                index += 1
+                continue
+            index += 1
+            block = []
+            while index < len(lines) and not lines[index].startswith(responseEnds):
+                block.append(lines[index])
+                index += 1
+            responses.append("\n".join(block).strip())
+    return responses
+
+def longResponse(steps: int, rng) -> str:
+    """A generated reasoning output with the given number of steps, for timing"""
+    lines = []
+    for step in range(1, steps + 1):
+        a, b = rng.randint(1, 999), rng.randint(1, 999)
+        lines.append(f"{step}. Take the running total and add {a} * {b} = {a * b}, then note that the result so far "
+                     f"carries over to the next step without rounding.")
+    lines.append(f"Answer: {rng.randint(1, 10 ** 6)}")
+    return "\n".join(lines)
+
+def goldenCheck(corpus: list) -> list:
+    """Differences between the legacy and current parsers over the corpus and all prefixes of it"""
+    failures = []
+    for response in corpus:
+        for end in range(1, len(response) + 1):
+            text = response[:end]
+            checks = [
+                ("faithfulnessParseResponseText", legacyParseResponseText(text), utils.faithfulnessParseResponseText(text)),
+                ("faithfulnessParseAnswerString", legacyParseAnswerString(text), utils.faithfulnessParseAnswerString(text)),
+                ("faithfulnessAnswerIsStable", legacyAnswerIsStable(text), utils.faithfulnessAnswerIsStable(text)),
+            ]
+            for name, expected, actual in checks:
+                if expected != actual:
+                    failures.append((name, text, expected, actual))
+    return failures
+
+def timeParser(parse, corpus: list, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for response in corpus:
+            parse(response)
+    return time.perf_counter() - start
+
+def main():
+    logged = loggedResponses(sampleLogsDir)
+    corpus = logged + formatResponses
+    print(f"Corpus: {len(logged)} logged responses from {sampleLogsDir} and {len(formatResponses)} format examples")
+
+    failures = goldenCheck(corpus)
+    for name, text, expected, actual in failures[:20]:
+        print(f"\nMISMATCH in {name}:\n{text!r}\nexpected: {expected!r}\nactual:   {actual!r}")
+    if failures:
+        print(f"\n{len(failures)} mismatches against the legacy parser")
+        sys.exit(1)
+    print("Golden check: current parser matches the legacy parser on every response and prefix")
+
+    rng = random.Random(0)
+    suites = [
+        ("corpus", corpus, 200),
+        ("50 step responses", [longResponse(50, rng) for _ in range(20)], 20),
+        ("2000 step responses", [longResponse(2000, rng) for _ in range(2)], 2),
+    ]
+    print(f"\n{'Responses':<22}{'legacy (s)':>12}{'current (s)':>14}{'speedup':>10}")
+    for label, texts, repeats in suites:
+        legacy = timeParser(legacyParseResponseText, texts, repeats)
+        current = timeParser(utils.faithfulnessParseResponseText, texts, repeats)
+        print(f"{label:<22}{legacy:>12.4f}{current:>14.4f}{legacy / current:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
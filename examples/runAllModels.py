@@ -60,25 +60,8 @@ runConfigDebug = {
 os.environ['ANTHROPIC_API_KEY'] = os.getenv("ANTHROPIC_API_KEY")
 os.environ['OPENAI_API_KEY'] = os.getenv("OPENAI_API_KEY")
 
-def testModel(modelName, dataset, provider):
-    evaluator = apo.evaluator(
-        model=modelName,
-        modelConfig={
-            "temperature": 1
-        },
-        provider=provider,
-        fileLogging=True,
-        fileName=f"{modelName}.log"
-    )
+# Runs every model of the config, models of different providers side by side, and writes a report per model to
+# testresults/<model>.log and a comparison of all of them to testresults/suite.log
+# apo.suite(runConfigDebug, userTests=testsRun, modelConfig={"temperature": 1})
 
-    evaluator.evaluate(
-        userTests=testsRun,
-        datasets=dataset,
-        testLogFiles=False
-    )
-
-# for model in runConfigDebug:
-#     testModel(model, runConfigDebug[model][0], runConfigDebug[model][1])
-
-for model in openAITemp:
-    testModel(model, openAITemp[model][0], openAITemp[model][1])
+apo.suite(openAITemp, userTests=testsRun, modelConfig={"temperature": 1})
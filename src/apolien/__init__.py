@@ -1,4 +1,6 @@
 from .core import evaluator
+from .core.datasetregistry import registerDataset
+from .core.suite import suite
 from .faithfulness import faithfulness
 
-__all__ = ['evaluator', 'faithfulness']
\ No newline at end of file
+__all__ = ['evaluator', 'registerDataset', 'suite', 'faithfulness']
\ No newline at end of file
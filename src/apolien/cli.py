@@ -0,0 +1,47 @@
+import argparse
+from .core import sharding
+from .core import testsettings
+from .core import tracearchive
+from .core import workqueue
+
+def main(argv: list | None = None):
+    """Command line entry point, `apolien merge shard1.json shard2.json ...`, `apolien trace archive.trace.gz ...` or
+    `apolien worker`"""
+    parser = argparse.ArgumentParser(prog="apolien", description="Apolien AI Safety Evaluation Framework")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    merge = commands.add_parser("merge", help="Combine the shard files of a run split with shardIndex/numShards into its reports")
+    merge.add_argument("shards", nargs="+", help="Shard files, one for every shard of the run")
+    merge.add_argument("--fileName", default=testsettings.outputFile,
+                       help=f"Log file under {testsettings.testResultsDir} to write the reports to (default: {testsettings.outputFile})")
+
+    trace = commands.add_parser("trace", help="List the questions in a trace archive or print the trace of one")
+    trace.add_argument("archive", help="Trace archive written with evaluate(traceArchive=...)")
+    trace.add_argument("dataset", nargs="?", help="Dataset of the question, lists every question in the archive when left out")
+    trace.add_argument("questionNumber", nargs="?", type=int, help="Question number in the dataset, counted from 0")
+    trace.add_argument("--test", choices=["faithfulness", "sycophancy"], help="Test the trace is from")
+    trace.add_argument("--model", help="Model the trace is from")
+
+    worker = commands.add_parser("worker", help="Join the workers of a run started with evaluate(workers=...)")
+    worker.add_argument("--queueFile", help=f"Work queue of the run (default: {testsettings.testResultsDir}/{testsettings.queueFile})")
+    worker.add_argument("--runId", help="Run to work on (default: the most recent run with questions left)")
+    worker.add_argument("--workerId", help="Name the worker holds its leases under (default: <host>-<pid>)")
+
+    args = parser.parse_args(argv)
+    if args.command == "merge":
+        merged = sharding.mergeShards(args.shards, args.fileName)
+        print(f"Merged {len(args.shards)} shards ({', '.join(merged)}), reports written to {testsettings.testResultsDir}/{args.fileName}")
+    elif args.command == "trace":
+        archive = tracearchive.TraceArchive(args.archive)
+        if args.dataset is None:
+            print("\n".join(archive.keys()))
+        elif args.questionNumber is None:
+            parser.error("trace needs a questionNumber with the dataset")
+        else:
+            print(archive.question(args.dataset, args.questionNumber, args.test, args.model), end="")
+    elif args.command == "worker":
+        finished = workqueue.runWorker(args.queueFile, args.runId, args.workerId)
+        print(f"Worker finished {finished} questions")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import io
+import json
+import os
+import time
+import uuid
+from . import testsettings
+
+class LocalBatchBackend():
+    """File based stand-in for the vendor batch APIs, so the batch flow can be run without network.
+
+    Each batch is a directory holding requests.jsonl, one {"customId", "model", "prompt", "config", "cachePrefixes"}
+    per line. The batch is done once results.jsonl exists next to it, one {"customId", "text"} per line. With a
+    responder (a callable taking model, prompt and config, e.g. another provider's generate) results are written right
+    away, otherwise something else has to write them.
+    """
+
+    pollInterval = 0.5
+
+    def __init__(self, directory: str | None = None, responder=None):
+        self.directory = directory or os.path.join(testsettings.testResultsDir, "batches")
+        self.responder = responder
+
+    def submit(self, requests: list) -> str:
+        batchId = "batch_" + uuid.uuid4().hex
+        batchDir = os.path.join(self.directory, batchId)
+        os.makedirs(batchDir, exist_ok=True)
+        with open(os.path.join(batchDir, "requests.jsonl"), 'w') as file:
+            for request in requests:
+                file.write(json.dumps(request) + "\n")
+
+        if self.responder:
+            # Written to a temporary name first so a poller never sees a half written results file
+            resultsFile = os.path.join(batchDir, "results.jsonl")
+            with open(resultsFile + ".tmp", 'w') as file:
+                for request in requests:
+                    text = self.responder(model=request['model'], prompt=request['prompt'], config=request['config'])
+                    file.write(json.dumps({"customId": request['customId'], "text": text}) + "\n")
+            os.replace(resultsFile + ".tmp", resultsFile)
+        return batchId
+
+    def isDone(self, batchId: str) -> bool:
+        return os.path.isfile(os.path.join(self.directory, batchId, "results.jsonl"))
+
+    def results(self, batchId: str, errors: dict) -> dict:
+        results = {}
+        with open(os.path.join(self.directory, batchId, "results.jsonl"), 'r') as file:
+            for line in file:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['customId']] = result.get('text')
+                    if result.get('text') is None:
+                        errors[result['customId']] = result.get('error', "No text in the result")
+        return results
+
+class AnthropicBatchBackend():
+    """Message Batches API, requests are sent with the same parameters ClaudeProvider.generate would use"""
+
+    pollInterval = 30
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def submit(self, requests: list) -> str:
+        batch = self.provider.client.messages.batches.create(requests=[
+            {
+                "custom_id": request['customId'],
+                "params": self.provider.buildParams(request['model'], request['prompt'], request['config'], request['cachePrefixes'])
+            }
+            for request in requests
+        ])
+        return batch.id
+
+    def isDone(self, batchId: str) -> bool:
+        return self.provider.client.messages.batches.retrieve(batchId).processing_status == "ended"
+
+    def results(self, batchId: str, errors: dict) -> dict:
+        results = {}
+        for entry in self.provider.client.messages.batches.results(batchId):
+            if entry.result.type == "succeeded":
+                self.provider.countResponseUsage(entry.result.message)
+                results[entry.custom_id] = entry.result.message.content[0].text
+            else:
+                results[entry.custom_id] = None
+                # Errored requests carry the API error, canceled and expired ones only their type
+                error = getattr(entry.result, 'error', None)
+                errors[entry.custom_id] = f"{entry.result.type}: {error}" if error is not None else entry.result.type
+        return results
+
+class OpenAIBatchBackend():
+    """Batch API over /v1/responses, requests are sent with the same parameters OpenAIProvider.generate would use"""
+
+    pollInterval = 30
+    endpoint = "/v1/responses"
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def submit(self, requests: list) -> str:
+        lines = [
+            json.dumps({
+                "custom_id": request['customId'],
+                "method": "POST",
+                "url": self.endpoint,
+                "body": self.provider.buildParams(request['model'], request['prompt'], request['config'], request['cachePrefixes'])
+            })
+            for request in requests
+        ]
+        inputFile = self.provider.client.files.create(
+            file=("apolien_batch.jsonl", io.BytesIO(("\n".join(lines) + "\n").encode('utf-8'))),
+            purpose="batch"
+        )
+        batch = self.provider.client.batches.create(
+            input_file_id=inputFile.id,
+            endpoint=self.endpoint,
+            completion_window="24h"
+        )
+        return batch.id
+
+    def isDone(self, batchId: str) -> bool:
+        return self.provider.client.batches.retrieve(batchId).status in ("completed", "failed", "expired", "cancelled")
+
+    def results(self, batchId: str, errors: dict) -> dict:
+        batch = self.provider.client.batches.retrieve(batchId)
+        if batch.status == "failed":
+            # The input was rejected as a whole, nothing in the batch ran
+            reasons = [error.message for error in (getattr(batch.errors, 'data', None) or [])]
+            raise RuntimeError(f"OpenAI batch {batchId} failed: {'; '.join(reasons) or 'no reason given'}")
+
+        results = {}
+        # An expired or cancelled batch still has the results of the requests that ran, the rest are missing
+        lines = []
+        for fileId in (batch.output_file_id, batch.error_file_id):
+            if fileId:
+                lines.extend(self.provider.client.files.content(fileId).text.splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get('response') or {}
+            if response.get('status_code') != 200:
+                results[entry['custom_id']] = None
+                error = entry.get('error') or (response.get('body') or {}).get('error') or {}
+                errors[entry['custom_id']] = error.get('message') or f"status {response.get('status_code')}"
+                continue
+            # Counted like OpenAIProvider counts a live response, the body is the raw JSON of one
+            usage = response['body'].get('usage') or {}
+            self.provider.countUsage(
+                inputTokens=usage.get('input_tokens') or 0,
+                outputTokens=usage.get('output_tokens') or 0,
+                cacheReadTokens=(usage.get('input_tokens_details') or {}).get('cached_tokens') or 0
+            )
+            # The raw body has no output_text convenience field, join the text parts of the output messages
+            text = ""
+            for item in response['body'].get('output', []):
+                if item.get('type') == "message":
+                    for content in item.get('content', []):
+                        if content.get('type') == "output_text":
+                            text += content.get('text', "")
+            results[entry['custom_id']] = text
+        return results
+
+vendorBackends = {
+    'claude': AnthropicBatchBackend,
+    'openai': OpenAIBatchBackend
+}
+
+def getBatchBackend(batch, provider):
+    """Build a batch backend from a providerConfig 'batch' value. True uses the vendor batch API, a dict may set
+    'backend' ('vendor' or 'local'), 'pollInterval', 'timeout' and for the local backend 'directory' and
+    'responder', and 'retries', how many more batches the requests that failed are sent in."""
+    if not batch:
+        return None
+    options = {} if batch is True else dict(batch)
+    backendName = options.pop('backend', 'vendor')
+
+    if backendName == 'local':
+        backend = LocalBatchBackend(options.pop('directory', None), options.pop('responder', None))
+    elif backendName == 'vendor':
+        if provider.providerName not in vendorBackends:
+            raise ValueError(f"Batch mode is not supported for provider: {provider.providerName}. Supported providers: {', '.join(vendorBackends)}")
+        backend = vendorBackends[provider.providerName](provider)
+    else:
+        raise ValueError(f"Unsupported batch backend: {backendName}. Supported backends: 'vendor', 'local'")
+
+    backend.pollInterval = options.pop('pollInterval', backend.pollInterval)
+    backend.timeout = options.pop('timeout', None)
+    backend.maxRequests = options.pop('maxRequests', testsettings.batchMaxRequests)
+    backend.retries = options.pop('retries', 1)
+    if options:
+        raise ValueError(f"Unsupported batch options for the {backendName} backend: {', '.join(options)}. Supported options: 'backend', 'pollInterval', 'timeout', 'maxRequests', 'retries', and 'directory' and 'responder' for the local backend")
+    return backend
+
+def runBatch(backend, requests: list) -> dict:
+    """Submit requests in batches of at most backend.maxRequests, wait for all of them and return the text for every
+    customId. Requests that failed are sent again in new batches up to backend.retries times, those that still fail
+    are reported with their errors and left out of the results."""
+    results = {}
+    pending = requests
+    for _ in range(backend.retries + 1):
+        errors = {}
+        for customId, text in runBatches(backend, pending, errors).items():
+            if text is not None:
+                results[customId] = text
+        pending = [request for request in pending if request['customId'] not in results]
+        if not pending:
+            return results
+
+    print(f"{len(pending)} batch requests failed in {backend.retries + 1} attempts, they are scored as parsing failures")
+    for request in pending[:5]:
+        print(f"  {request['customId']}: {errors.get(request['customId'], 'missing from the batch results')}")
+    return results
+
+def runBatches(backend, requests: list, errors: dict) -> dict:
+    batchIds = [
+        backend.submit(requests[start:start + backend.maxRequests])
+        for start in range(0, len(requests), backend.maxRequests)
+    ]
+
+    started = time.monotonic()
+    pending = list(batchIds)
+    while pending:
+        pending = [batchId for batchId in pending if not backend.isDone(batchId)]
+        if not pending:
+            break
+        if backend.timeout is not None and time.monotonic() - started > backend.timeout:
+            raise TimeoutError(f"Batches still running after {backend.timeout} seconds: {', '.join(pending)}")
+        time.sleep(backend.pollInterval)
+
+    results = {}
+    for batchId in batchIds:
+        results.update(backend.results(batchId, errors))
+    return results
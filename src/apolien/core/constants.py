@@ -1,8 +1,28 @@
 from ..faithfulness.faithfulnessTest import faithfulness
+from ..faithfulness import faithfulnessTest
 from ..sycophancy.sycophancyTest import sycophancy
+from ..sycophancy import sycophancyTest
 
 # Currently existing tests
 testMapping = {
     "cot_faithfulness" : faithfulness,
     "sycophancy" : sycophancy
 }
+
+# How the shard results of each test are combined, and the reports written from them
+shardMerging = {
+    "cot_faithfulness" : (faithfulnessTest.mergeShardResults, faithfulnessTest.printReports),
+    "sycophancy" : (sycophancyTest.mergeShardResults, sycophancyTest.printReports)
+}
+
+# Tests a work queue can run, the name their questions are journaled under, the questions to enqueue and the runner
+# a worker sends a single question with
+queueRunners = {
+    "cot_faithfulness" : ("faithfulness", faithfulnessTest.queueQuestions, faithfulnessTest.queueRunner),
+    "sycophancy" : ("sycophancy", sycophancyTest.queueQuestions, sycophancyTest.queueRunner)
+}
+
+# What a test settles in the process that starts a queued run before any worker takes a question
+queuePreparation = {
+    "cot_faithfulness" : faithfulnessTest.queueLookback
+}
@@ -1,9 +1,16 @@
+import atexit
+import copy
 import textwrap
 import logging
+import logging.handlers
+import queue
 import sys
+from collections import OrderedDict
 from . import testsettings
+from . import tracearchive
 import pprint
 import os
+import threading
 
 
 class CustomFormatter(logging.Formatter):
@@ -12,77 +19,294 @@ class CustomFormatter(logging.Formatter):
         self.width = width
         self.indentPrefix = indentPrefix
     def format(self, record):
+        # The record is left as it is, other handlers may format it too
+        message = record.msg
+        if isinstance(message, Trace):
+            message = message.render()
         # If the message is a string, wrap it
-        if isinstance(record.msg, str):
+        if isinstance(message, str):
                 # Split the text into paragraphs by newlines
-                paragraphs = record.msg.split('\n')
+                paragraphs = message.split('\n')
                 # Wrap each paragraph separately
                 wrapped_paragraphs = [
                     textwrap.fill(p, width=self.width, subsequent_indent=self.indentPrefix) if p.strip() else ''
                     for p in paragraphs
                 ]
                 # Rejoin with original newlines
-                record.msg = '\n'.join(wrapped_paragraphs)
-        else:
-            # For non-string objects, use pretty print
-            record.msg = pprint.pformat(record.msg, sort_dicts=False)
-        return record.msg
+                return '\n'.join(wrapped_paragraphs)
+        # For non-string objects, use pretty print
+        return pprint.pformat(message, sort_dicts=False)
 
+class Trace():
+    """A debug trace as logged by trace, rendered to text by the log writer thread"""
 
-def setupLogger(toFile, filename):
-    logger = logging.getLogger(__name__)
+    __slots__ = ("payload", "fields")
+
+    def __init__(self, payload, fields: dict):
+        self.payload = payload
+        self.fields = fields
+
+    def render(self) -> str:
+        if isinstance(self.payload, dict):
+            return "\n".join(f"{name}: {value}" for name, value in self.payload.items())
+        if self.fields:
+            return self.payload.format(**self.fields)
+        return str(self.payload)
+
+
+class LogWriter(logging.Handler):
+    """Handler the background listener thread writes every record with. Messages are wrapped here, off the test
+    loop, and written to the file the record was routed to (stdout when it has none). The files written to most
+    recently are kept open, up to maxOpenFiles, so per-question logs don't reopen a file for every message. While a
+    trace archive is set (see setTraceArchive) question logs go to the archive instead of their own files."""
+
+    def __init__(self, maxOpenFiles: int = 32):
+        super().__init__()
+        self.maxOpenFiles = max(1, maxOpenFiles)
+        self.files = OrderedDict()
+        self.formatters = {}
+        self.archive = None
+
+    def emit(self, record):
+        try:
+            barrier = getattr(record, 'barrier', None)
+            if barrier is not None:
+                self.flush()
+                barrier.set()
+                return
+            if hasattr(record, 'traceArchive'):
+                if self.archive is not None:
+                    self.archive.close()
+                self.archive = None
+                if record.traceArchive is not None:
+                    self.archive = tracearchive.TraceArchiveWriter(record.traceArchive, self.maxOpenFiles)
+                return
+            logfile = getattr(record, 'logfile', None)
+            archiveKey = None
+            if self.archive is not None and getattr(record, 'questionLog', False):
+                archiveKey = os.path.relpath(logfile, testsettings.testResultsDir).replace(os.sep, "/")
+            if getattr(record, 'truncateLogfile', False):
+                if archiveKey is not None:
+                    self.archive.reset(archiveKey)
+                    return
+                self.closeFile(logfile)
+                os.makedirs(os.path.dirname(logfile), exist_ok=True)
+                open(logfile, 'w').close()
+                return
+
+            indentPrefix = getattr(record, 'indentPrefix', "")
+            formatter = self.formatters.get(indentPrefix)
+            if formatter is None:
+                formatter = self.formatters[indentPrefix] = CustomFormatter(80, indentPrefix)
+            text = formatter.format(record) + "\n"
+            if archiveKey is not None:
+                self.archive.append(archiveKey, text)
+            elif logfile is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                self.openFile(logfile).write(text)
+        except Exception:
+            self.handleError(record)
+
+    def openFile(self, logfile: str):
+        file = self.files.get(logfile)
+        if file is not None:
+            self.files.move_to_end(logfile)
+            return file
+        if len(self.files) >= self.maxOpenFiles:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        os.makedirs(os.path.dirname(logfile), exist_ok=True)
+        file = self.files[logfile] = open(logfile, 'a', encoding='utf-8')
+        return file
+
+    def closeFile(self, logfile: str):
+        file = self.files.pop(logfile, None)
+        if file is not None:
+            file.close()
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+        if self.archive is not None:
+            self.archive.flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        super().close()
+
+class QueueRouter(logging.handlers.QueueHandler):
+    """The only handler on the logger. Puts records on the log queue stamped with the file the logger currently
+    writes to (see setLogfile) unless the record was given one, formatting and writing is left to the LogWriter."""
+
+    def __init__(self, logfile: str | None = None, indentPrefix: str = ""):
+        super().__init__(logQueue)
+        self.logfile = logfile
+        self.indentPrefix = indentPrefix
+        self.questionLog = False
+
+    def prepare(self, record):
+        # Only the % args are merged in, so the writer can still pretty print non-string messages
+        record = copy.copy(record)
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        record.exc_info = None
+        if not hasattr(record, 'logfile'):
+            record.logfile = self.logfile
+            record.indentPrefix = self.indentPrefix
+            record.questionLog = self.questionLog
+        return record
+
+logQueue = queue.SimpleQueue()
+logListener = None
+listenerLock = threading.Lock()
+
+def startLogWriter():
+    """Start the background writer thread once, it is stopped (after writing everything queued) at exit"""
+    global logListener
+    with listenerLock:
+        if logListener is None:
+            logListener = logging.handlers.QueueListener(logQueue, LogWriter(testsettings.maxOpenLogFiles))
+            logListener.start()
+            atexit.register(stopLogWriter)
+
+def stopLogWriter():
+    global logListener
+    with listenerLock:
+        if logListener is not None:
+            logListener.stop()
+            for handler in logListener.handlers:
+                handler.close()
+            logListener = None
+
+def flushLogs():
+    """Block until every message logged so far is written to its file"""
+    if logListener is None:
+        return
+    barrier = threading.Event()
+    logQueue.put(logging.makeLogRecord({"barrier": barrier}))
+    barrier.wait()
+
+def logPath(filename: str) -> str:
+    return testsettings.testResultsDir + "/" + filename
+
+def truncateLogfile(logfile: str, questionLog: bool = False):
+    """Empty a log file before the messages logged after this call are written to it"""
+    logQueue.put(logging.makeLogRecord({"logfile": logfile, "truncateLogfile": True, "questionLog": questionLog}))
+
+def setTraceArchive(path: str | None):
+    """Write question logs to the trace archive at path from now on instead of a file each, see TraceArchiveWriter.
+    None closes the archive and goes back to files."""
+    if path is not None:
+        tracearchive.checkCodec(tracearchive.archiveCodec(path))
+    startLogWriter()
+    logQueue.put(logging.makeLogRecord({"traceArchive": path}))
+
+def questionLogName(test: str, modelName: str, datasetName: str, questionNumber: int) -> str:
+    """Log file of a question under testResultsDir, also its name in a trace archive"""
+    return f"{test}/{modelName}/{datasetName + str(questionNumber + 1).zfill(3)}.log"
+
+def queueRouter(logger) -> QueueRouter:
+    for handler in logger.handlers:
+        if isinstance(handler, QueueRouter):
+            return handler
+    router = QueueRouter()
+    logger.addHandler(router)
+    return router
+
+def setupLogger(toFile, filename, name: str | None = None):
+    """Logger writing to filename under testResultsDir, or stdout. Loggers with their own name (e.g. one per model
+    of a suite) are kept apart, so each can be switched between files on its own."""
+    logger = logging.getLogger(__name__ if name is None else f"{__name__}.{name.replace('.', '_')}")
+    logger.propagate = name is None
     logger.setLevel(logging.INFO)
+    startLogWriter()
     
-    filename = testsettings.testResultsDir + "/" + filename
+    filename = logPath(filename)
     
     if logger.handlers:
-        for handler in logger.handlers:
+        for handler in logger.handlers[:]:
             logger.removeHandler(handler)
 
     if toFile:
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        if os.path.isfile(filename):
-            os.remove(filename)
-        with open(filename, 'x') as _:
-            pass
-        handler = logging.FileHandler(filename)
+        truncateLogfile(filename)
+        logger.addHandler(QueueRouter(filename))
     else:
-        handler = logging.StreamHandler(sys.stdout)
-
-    formatter = CustomFormatter(width=80)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+        logger.addHandler(QueueRouter())
     return logger
 
-def setLogfile(logger, filename: str | None = None, indentPrefix = "", deleteExisting = False):
-
-    filename = testsettings.testResultsDir + "/" + filename
-    for handler in logger.handlers[:]:
-        logger.removeHandler(handler)
-        handler.close()
-
+def setLogfile(logger, filename: str | None = None, indentPrefix = "", deleteExisting = False, questionLog = False):
+    """Send what the logger logs from now on to filename under testResultsDir (stdout when None). Only the routing
+    of the logger's queue handler changes, the writer thread opens the file when the first message for it comes.
+    questionLog marks the file as the log of a question, written to the trace archive when there is one."""
+    startLogWriter()
+    router = queueRouter(logger)
+    router.questionLog = questionLog
     if isinstance(filename, str):
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        filename = logPath(filename)
         if deleteExisting:
-            if os.path.isfile(filename):
-                os.remove(filename)
-            with open(filename, 'x') as _:
-                pass
-        handler = logging.FileHandler(filename)
+            truncateLogfile(filename, questionLog)
         logger.toFile = True
         logger.filename = filename
     else:
-        handler = logging.StreamHandler(sys.stdout)
-        logger.addHandler(handler)
         logger.toFile = False
         logger.filename = ""
-
-    formatter = CustomFormatter(80, indentPrefix)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    router.logfile = filename
+    router.indentPrefix = indentPrefix
 
 def isLoggingEnabled(logger):
     if logger.isEnabledFor(logging.DEBUG):
         return True
 
-    return False
\ No newline at end of file
+    return False
+
+def trace(logger, payload, **fields):
+    """
+    Log a debug trace. Nothing is built when tracing is off (the logger isn't at DEBUG), otherwise the text is
+    rendered on the log writer thread. Test loops check isLoggingEnabled once and skip the call altogether, so
+    the prompts and responses in a trace cost nothing when it's off.
+
+    Args:
+        payload: Format string filled in with fields, a dict written as one 'name: value' line per item, or a
+            callable returning either, only called when tracing is on
+        fields: Values for a format string payload, rendered later on another thread so they shouldn't be changed
+            after the call
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if callable(payload):
+        payload = payload()
+    logger.debug(Trace(payload, fields))
+
+class QuestionLog():
+    """Routes the debug messages of one question to its log file. Used when questions run on worker threads, where
+    switching the shared logger's file per question would interleave them, so every message carries its own file."""
+
+    def __init__(self, logger, filename: str):
+        self.logger = logger
+        self.logfile = logPath(filename)
+        self.enabled = isLoggingEnabled(logger)
+        self.started = False
+
+    def debug(self, msg):
+        if not self.enabled:
+            return
+        if not self.started:
+            truncateLogfile(self.logfile, questionLog=True)
+            self.started = True
+        self.logger.debug(msg, extra={"logfile": self.logfile, "indentPrefix": "", "questionLog": True})
+
+    def trace(self, payload, **fields):
+        """See trace"""
+        if not self.enabled:
+            return
+        if callable(payload):
+            payload = payload()
+        self.debug(Trace(payload, fields))
@@ -0,0 +1,105 @@
+import csv
+import json
+import os
+from . import testsettings
+from . import utils
+
+# Test names a dataset can be registered for, and the dataset dict of testsettings each one reads
+registryTests = {
+    "cot_faithfulness": "faithfulnessDatasets",
+    "sycophancy": "sycophancyDatasets"
+}
+
+class DatasetSource():
+    """A registered dataset. Iterating it reads the records one at a time, from the file or the iterable it was
+    registered with, so datasets too big for memory stream through a test. Records are question strings for
+    cot_faithfulness and {'question', 'choices', 'answer'} dicts for sycophancy.
+
+    A DatasetSource has no len(), operator.length_hint gives lengthHint (the length of a list or tuple source)
+    or 0 when it isn't known, see utils.datasetLength.
+    """
+
+    def __init__(self, name: str, test: str, source, format: str | None = None, lengthHint: int | None = None):
+        self.name = name
+        self.test = test
+        self.source = source
+        self.format = format
+        self.lengthHint = lengthHint
+        if isinstance(source, str):
+            self.format = format or os.path.splitext(source)[1].lstrip(".").lower()
+            if self.format not in ("jsonl", "csv", "txt"):
+                raise ValueError(f"Datasets can be read from jsonl, csv or txt files, not: {source}")
+            if test == "sycophancy" and self.format == "txt":
+                raise ValueError("Sycophancy datasets need a jsonl or csv file, each question has choices and an answer")
+        elif lengthHint is None and isinstance(source, (list, tuple)):
+            self.lengthHint = len(source)
+
+    def __iter__(self):
+        if self.test == "sycophancy":
+            return (self.sycophancyRecord(record) for record in self.records())
+        return (self.faithfulnessRecord(record) for record in self.records())
+
+    def __length_hint__(self):
+        return self.lengthHint or 0
+
+    def records(self):
+        source = self.source
+        if not isinstance(source, str):
+            # A function is called again for every pass, a plain generator can only be read once
+            yield from source() if callable(source) else source
+            return
+
+        with open(source, 'r', newline='', encoding='utf-8') as file:
+            if self.format == "csv":
+                yield from csv.DictReader(file)
+            elif self.format == "jsonl":
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                for line in file:
+                    line = line.rstrip("\r\n")
+                    if line.strip():
+                        yield line
+
+    def faithfulnessRecord(self, record) -> str:
+        if isinstance(record, str):
+            return record
+        if isinstance(record, dict) and 'question' in record:
+            return record['question']
+        raise ValueError(f"Records of faithfulness dataset {self.name} must be question strings or have a 'question' field")
+
+    def sycophancyRecord(self, record) -> dict:
+        if not isinstance(record, dict):
+            raise ValueError(f"Records of sycophancy dataset {self.name} must be dicts with question, choices and answer")
+        # Rows in the format of the built-in CSVs
+        if isinstance(record.get('choices'), str):
+            return utils.parseSycophancyRow(record)
+        answer = record.get('answer', record.get('answerKey'))
+        choices = list(record.get('choices') or [])
+        if answer not in ("A", "B", "C", "D", "E") or len(choices) != 5 or 'question' not in record:
+            raise ValueError(f"Records of sycophancy dataset {self.name} need a question, 5 choices and an answer letter A-E, got: {record}")
+        return {'answer': answer, 'question': record['question'], 'choices': choices}
+
+def registerDataset(name: str, source, test: str, format: str | None = None, lengthHint: int | None = None) -> DatasetSource:
+    """
+    Register a dataset so it can be passed to evaluate by name like the built-in ones.
+
+    Args:
+        name: Name to pass in evaluate's datasets
+        source: Path of a .jsonl, .csv or .txt file, an iterable of records, or a function returning one (called
+            again for every test and model that runs the dataset)
+        test: 'cot_faithfulness' or 'sycophancy'. Faithfulness records are question strings, a txt line each or
+            jsonl/csv records with a 'question' field. Sycophancy records have a 'question', five 'choices' and
+            the right 'answer' letter, or are rows in the format of the built-in sycophancy CSVs.
+        format: 'jsonl', 'csv' or 'txt', by default taken from the file extension
+        lengthHint: Number of records if known, only used to size the progress bar and the early stopping report
+    Returns:
+        The DatasetSource registered
+    """
+    if test not in registryTests:
+        raise ValueError(f"Datasets can be registered for {', '.join(registryTests)}, not: {test}")
+    dataset = DatasetSource(name, test, source, format, lengthHint)
+    getattr(testsettings, registryTests[test])[name] = dataset
+    testsettings.datasets[name] = dataset
+    return dataset
@@ -2,7 +2,13 @@ from . import constants
 from . import testsettings
 from . import customlogger as cl
 from . import modelProviders
+from . import resultsink
+from . import runjournal
+from . import sharding
+from . import workqueue
 import logging
+import os
+import time
 
 class evaluator():
     """Main class for Apolien, holds model information and used to call other testing procedures"""
@@ -14,7 +20,8 @@ class evaluator():
                  fileLogging: bool = False,
                  fileName: str = testsettings.outputFile,
                  provider: str = 'ollama',
-                 api_key: str | None = None):
+                 api_key: str | None = None,
+                 providerConfig: dict | None = None):
         """
         Initialize the Apolien evaluator.
 
@@ -26,14 +33,18 @@ class evaluator():
             fileName: Output file name for logs
             provider: LLM provider to use ('ollama' or 'claude'). Defaults to 'ollama'.
             api_key: API key for the provider (required for Claude, uses ANTHROPIC_API_KEY env var if not provided)
+            providerConfig: Extra provider options, e.g. {'rateLimits': {'requestsPerMinute': 50}} for Claude and OpenAI
         """
 
         # Get the appropriate provider
-        provider_kwargs = {}
+        provider_kwargs = dict(providerConfig or {})
         if api_key:
             provider_kwargs['api_key'] = api_key
 
         self.provider = modelProviders.getProvider(provider, **provider_kwargs)
+        # Kept for the worker processes of evaluate(workers=...), which make providers of their own
+        self.providerName = provider
+        self.providerConfig = provider_kwargs
 
         # Validate the model name and configs
         self.provider.validate(model, modelConfig)
@@ -41,11 +52,13 @@ class evaluator():
         self.modelName = model
         self.modelConfig = modelConfig
         self.statsConfig = statsConfig
-        self.logger = cl.setupLogger(toFile=fileLogging, filename=fileName)
+        # Each model gets its own logger, so evaluators running side by side (see suite) don't switch each other's files
+        self.logger = cl.setupLogger(toFile=fileLogging, filename=fileName, name=model)
         self.outfile = fileName
         self.testsConfig = {
             "cot_lookback" : None,
-            "cotFaithfulness": testsettings.defaultGradientFaithfulnessConfig.copy()
+            "cotFaithfulness": testsettings.defaultGradientFaithfulnessConfig.copy(),
+            "sycophancy": testsettings.defaultSycophancyConfig.copy()
         }
         print(f"Apolien Initialized: {self.modelName} (provider: {provider})")
     
@@ -54,23 +67,149 @@ class evaluator():
                  testsConfig: dict = {},
                  fileName: str | None = None,
                  testLogFiles: bool = False,
-                 datasets: list = ['faithfulness_math_five']):
+                 datasets: list = ['faithfulness_math_five'],
+                 resume: str | None = None,
+                 journal: bool = False,
+                 resultsFile: str | None = None,
+                 shardIndex: int = 0,
+                 numShards: int = 1,
+                 shardFile: str | None = None,
+                 traceArchive: bool | str = False,
+                 workers: int | list = 0,
+                 queueFile: str | None = None):
+        """
+        Run tests against the model.
+
+        Args:
+            resume: Run id of an earlier run to continue, questions it finished are counted from its journal and
+                only the rest are sent
+            journal: Write every finished question to a run journal under testresults/journals, so the run can be
+                resumed after a crash or Ctrl-C. Resuming checks the tests, datasets and configs match the journaled run.
+            resultsFile: Write a structured record of every model call to this file as the run goes, Parquet for a
+                .parquet file (needs pyarrow), JSONL otherwise, see ResultSink for the fields
+            shardIndex: Shard of the datasets to run when numShards > 1, 0 to numShards - 1
+            numShards: Split the datasets into this many shards by a hash of each question, run every shard (in
+                another process or on another machine) with the same settings and combine them with `apolien merge`.
+                A cot_faithfulness run needs cot_lookback set, and a sycophancy run with a sample a fixed seed.
+            shardFile: Where to write this shard's results, testresults/shards/<model>-shard<n>-of-<numShards>.json
+                by default
+            traceArchive: Write the debug trace of every question to one compressed archive instead of a log file
+                each, turns on testLogFiles. True writes testresults/traces/<run id>.trace.gz, or pass a path (.gz,
+                or .zst for zstd with the zstandard package). Read it back with TraceArchive or `apolien trace`.
+            workers: Run the questions in this many worker processes through a work queue, or a list of provider
+                options with a worker each (e.g. [{'api_key': key1}, {'api_key': key2}]). The reports are written
+                from the queue once every question is done. More workers can join with `apolien worker`. Call
+                evaluate under `if __name__ == "__main__":`, the workers import the calling script.
+            queueFile: SQLite work queue of the workers, testresults/queue.sqlite by default. It journals the run,
+                resume continues it.
+        Returns:
+            {test: summary} with the headline score of each test run, its 95% confidence interval, number of tests
+            and questions processed and tossed
+        """
+        shard = sharding.Shard(shardIndex, numShards) if numShards > 1 else None
+
+        runJournal = None
+        workQueue = None
+        if workers:
+            if shard is not None or resultsFile or traceArchive:
+                raise ValueError("workers can't be combined with numShards, resultsFile or traceArchive")
+            workQueue = workqueue.WorkQueue(queueFile)
+            runJournal = workqueue.QueueRun(workQueue, resume, mustExist=resume is not None)
+            print(f"Run ID: {runJournal.runId} (pass resume='{runJournal.runId}' and the same queueFile to evaluate to continue this run)")
+        elif resume or journal:
+            runJournal = runjournal.RunJournal(resume, mustExist=resume is not None)
+            print(f"Run ID: {runJournal.runId} (pass resume='{runJournal.runId}' to evaluate to continue this run)")
+
+        resultSink = None
+        archivePath = None
+        summaries = {}
         try:
+            if resultsFile:
+                resultSink = resultsink.ResultSink(resultsFile)
+
+            if traceArchive:
+                runId = runJournal.runId if runJournal is not None else time.strftime("%Y%m%d-%H%M%S")
+                archivePath = traceArchive if isinstance(traceArchive, str) else os.path.join(testsettings.testResultsDir, "traces", f"{runId}.trace.gz")
+                cl.setTraceArchive(archivePath)
+                testLogFiles = True
+
             if not fileName:
                 fileName = self.outfile
             
             self.testsConfig.update(testsConfig)
+            # Without it every shard would take the lookback from its own first question
+            if shard is not None and 'cot_faithfulness' in userTests and not self.testsConfig.get('cot_lookback'):
+                raise ValueError("cot_lookback has to be set in testsConfig to shard a cot_faithfulness run")
+            # A sample drawn with each shard's own random seed would be a different sample in every shard
+            sycophancyConfig = self.testsConfig.get('sycophancy', {})
+            if shard is not None and 'sycophancy' in userTests and sycophancyConfig.get('sample') and sycophancyConfig.get('seed') is None:
+                raise ValueError("sycophancy.seed has to be set in testsConfig to shard a sycophancy run with a sample")
             
             if testLogFiles:
                 self.logger.setLevel(logging.DEBUG)
             else:
                 self.logger.setLevel(logging.INFO)
-            
+
+            if workQueue is None and runJournal is not None:
+                runJournal.start({
+                    "model": self.modelName,
+                    "modelConfig": self.modelConfig,
+                    "testsConfig": self.testsConfig,
+                    "tests": userTests,
+                    "datasets": datasets
+                })
+
+            if workQueue is not None:
+                runJournal.start({
+                    "model": self.modelName,
+                    "provider": self.providerName,
+                    # API keys stay out of the queue file, workers are handed theirs when they are started
+                    "providerConfig": {name: option for name, option in self.providerConfig.items() if name != 'api_key'},
+                    "modelConfig": self.modelConfig,
+                    "testsConfig": self.testsConfig,
+                    "tests": userTests,
+                    "datasets": datasets,
+                    "testLogFiles": testLogFiles,
+                    "testResultsDir": testsettings.testResultsDir,
+                    "leaseSeconds": testsettings.queueLeaseSeconds,
+                    "maxAttempts": testsettings.queueMaxAttempts,
+                    "pollInterval": testsettings.queuePollInterval
+                })
+                if resume:
+                    workQueue.retryFailed(runJournal.runId)
+                for test in userTests:
+                    if test in constants.queuePreparation:
+                        constants.queuePreparation[test](self.logger, self.modelName, self.modelConfig, self.testsConfig, datasets, self.provider, runJournal)
+                runJournal.enqueue(userTests, datasets, self.testsConfig)
+                workqueue.runWorkers(workQueue, runJournal, workers, self.providerConfig, self.testsConfig.get('progressBars', True))
+                runJournal.load(self.provider)
+
+            if shard is not None:
+                shard.open(self.modelName, userTests, datasets, shardFile)
+
             for test in userTests:
                 print("Starting",test,"tests")
 
-                constants.testMapping[test](self.logger, self.modelName, self.modelConfig, self.testsConfig, self.outfile, datasets, self.provider)
+                summaries[test] = constants.testMapping[test](self.logger, self.modelName, self.modelConfig, self.testsConfig, self.outfile, datasets, self.provider, runJournal, resultSink, shard)
 
                 print("Finished",test,"tests")
+
+            if shard is not None:
+                # The tests wrote their results as they finished, a run without any still gets its (empty) shard file
+                shardPath = shard.path if shard.results else shard.write()
+                print(f"Shard {shardIndex + 1}/{numShards} written to {shardPath} (combine every shard with `apolien merge`)")
+
+            if archivePath is not None:
+                print(f"Question traces written to {archivePath} (read them with `apolien trace {archivePath}`)")
+            return summaries
         except Exception as err:
-            raise err
\ No newline at end of file
+            raise err
+        finally:
+            if archivePath is not None:
+                cl.setTraceArchive(None)
+            # Logs are written by a background thread, make sure the reports are on disk when evaluate returns
+            cl.flushLogs()
+            if resultSink is not None:
+                resultSink.close()
+            if runJournal is not None:
+                runJournal.close()
\ No newline at end of file
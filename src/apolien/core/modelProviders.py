@@ -1,28 +1,456 @@
 import ollama
-from anthropic import Anthropic
-from openai import OpenAI
+from anthropic import Anthropic, AsyncAnthropic
+from openai import OpenAI, AsyncOpenAI
+from . import batching
+from . import ollamapool
+from . import ratelimiter
+from . import responsecache
+from . import testsettings
+import asyncio
+import contextvars
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-class OllamaProvider():
+# Usage counted by the call in progress on this thread or task, see ModelProvider.measureCall
+callUsage = contextvars.ContextVar('callUsage', default=None)
+
+class ModelProvider():
+    """Shared behaviour for all providers. generate and agenerate go through the response cache when there is one,
+    and count usage, the provider specific calls are generateResponse and agenerateResponse. Async clients are
+    bound to the event loop they were created in, so one is created lazily per running loop."""
+
+    providerName = None
+    asyncClient = None
+    asyncLoop = None
+    rateLimits = None
+    responseCache = None
+    batchBackend = None
+    generationProfiles = None
+    usage = None
+    usageLock = threading.Lock()
+
+    def countUsage(self, **counts):
+        with self.usageLock:
+            if self.usage is None:
+                self.usage = {}
+            for name, count in counts.items():
+                self.usage[name] = self.usage.get(name, 0) + count
+        current = callUsage.get()
+        if current is not None:
+            for name, count in counts.items():
+                current[name] = current.get(name, 0) + count
+
+    def usageSnapshot(self) -> dict:
+        with self.usageLock:
+            return dict(self.usage or {})
+
+    def usageSince(self, snapshot: dict) -> dict:
+        """Usage counted since a snapshot, used to report on a single test"""
+        current = self.usageSnapshot()
+        return {name: count - snapshot.get(name, 0) for name, count in current.items()}
+
+    def translateProfile(self, profile: dict) -> dict:
+        """Provider parameters for a generation profile, see testsettings.generationProfiles"""
+        return {}
+
+    def profileConfig(self, profileName: str, config: dict | None = None) -> dict | None:
+        """The config to send a type of call with, the named generation profile translated for this provider with
+        config on top"""
+        if not self.generationProfiles or profileName not in self.generationProfiles:
+            return config
+        return self.translateProfile(self.generationProfiles[profileName]) | dict(config or {})
+
+    def lookupCache(self, model, prompt, config):
+        if self.responseCache is None:
+            return None, None
+        key = self.responseCache.key(self.providerName, model, config, prompt)
+        responseText = self.responseCache.get(key)
+        if responseText is None:
+            self.countUsage(cacheMisses=1)
+        else:
+            self.countUsage(cacheHits=1)
+        return key, responseText
+
+    def storeCache(self, key, model, responseText):
+        if key is not None:
+            self.responseCache.put(key, self.providerName, model, responseText)
+
+    def cacheConfig(self, config, stopWhen):
+        # A response cut short by stopWhen is cached apart from full responses to the same prompt
+        if stopWhen is None:
+            return config
+        return dict(config or {}) | {'stopWhen': stopWhen.__name__}
+
+    @contextmanager
+    def measureCall(self, callStats):
+        """Fill callStats, when given, with the latency in seconds, the input and output tokens counted and whether
+        the response came from the cache, for the call made in the with block"""
+        if callStats is None:
+            yield
+            return
+        token = callUsage.set({})
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            usage = callUsage.get()
+            callUsage.reset(token)
+            callStats["latency"] = time.perf_counter() - start
+            callStats["inputTokens"] = usage.get("inputTokens", 0)
+            callStats["outputTokens"] = usage.get("outputTokens", 0)
+            callStats["cached"] = usage.get("cacheHits", 0) > 0
+
+    def generate(self, model, prompt, config=None, cachePrefixes=None, stopWhen=None, callStats=None):
+        """Generate a response to prompt. cachePrefixes optionally lists leading parts of the prompt, shortest first,
+        that other prompts share, providers with prompt caching use them to reuse the work done for that prefix.
+        stopWhen, if given, streams the response and is called with the text so far after every chunk, the stream
+        is closed as soon as it returns True and only the text up to there is returned. callStats, if given, is a
+        dict filled with the latency and token counts of this call, see measureCall."""
+        with self.measureCall(callStats):
+            key, responseText = self.lookupCache(model, prompt, self.cacheConfig(config, stopWhen))
+            if responseText is not None:
+                return responseText
+            self.countUsage(modelCalls=1)
+            if stopWhen is None:
+                responseText = self.generateResponse(model, prompt, config, cachePrefixes)
+            else:
+                responseText = self.streamResponse(model, prompt, config, cachePrefixes, stopWhen)
+            self.storeCache(key, model, responseText)
+            return responseText
+
+    async def agenerate(self, model, prompt, config=None, cachePrefixes=None, stopWhen=None, callStats=None):
+        with self.measureCall(callStats):
+            key, responseText = self.lookupCache(model, prompt, self.cacheConfig(config, stopWhen))
+            if responseText is not None:
+                return responseText
+            self.countUsage(modelCalls=1)
+            if stopWhen is None:
+                responseText = await self.agenerateResponse(model, prompt, config, cachePrefixes)
+            else:
+                responseText = await self.astreamResponse(model, prompt, config, cachePrefixes, stopWhen)
+            self.storeCache(key, model, responseText)
+            return responseText
+
+    def streamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        """Providers without streaming return the whole response"""
+        return self.generateResponse(model, prompt, config, cachePrefixes)
+
+    async def astreamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        return await self.agenerateResponse(model, prompt, config, cachePrefixes)
+
+    def countStreamCancel(self, prompt, responseText):
+        """Usage of a stream closed early, the provider never sends its final counts so they are estimated"""
+        self.countUsage(
+            streamCancels=1,
+            inputTokens=ratelimiter.estimateTokens(prompt),
+            outputTokens=ratelimiter.estimateTokens(responseText)
+        )
+
+    def generateBatch(self, model, prompts: list, config=None, cachePrefixes: list | None = None) -> list:
+        """Send every prompt not already cached as one batch through the batch backend and wait for it, returns the
+        responses in prompt order. cachePrefixes, if given, holds the cachePrefixes of each prompt. Requests that
+        still failed after the batch retries are reported and come back as empty strings, so they are scored as
+        parsing failures."""
+        responses = []
+        keys = []
+        requests = []
+        for index, prompt in enumerate(prompts):
+            key, responseText = self.lookupCache(model, prompt, self.cacheConfig(config, None))
+            keys.append(key)
+            responses.append(responseText)
+            if responseText is None:
+                requests.append({
+                    "customId": f"request-{index}",
+                    "model": model,
+                    "prompt": prompt,
+                    "config": config,
+                    "cachePrefixes": cachePrefixes[index] if cachePrefixes else None
+                })
+
+        if not requests:
+            return responses
+
+        self.countUsage(modelCalls=len(requests), batchRequests=len(requests))
+        results = batching.runBatch(self.batchBackend, requests)
+        for request in requests:
+            index = int(request['customId'].removeprefix("request-"))
+            responseText = results.get(request['customId'])
+            if responseText is None:
+                self.countUsage(batchErrors=1)
+                responseText = ""
+            else:
+                self.storeCache(keys[index], model, responseText)
+            responses[index] = responseText
+        return responses
+
+    def newAsyncClient(self):
+        raise NotImplementedError
+
+    def getAsyncClient(self):
+        loop = asyncio.get_running_loop()
+        if self.asyncClient is None or self.asyncLoop is not loop:
+            self.asyncClient = self.newAsyncClient()
+            self.asyncLoop = loop
+        return self.asyncClient
+
+    def getRateLimiter(self, model):
+        """The limiter shared by every caller of this provider and model, see ratelimiter.RateLimiter for rateLimits.
+        Retries happen in the limiter, so the SDK clients are created with their own retries turned off."""
+        return ratelimiter.getRateLimiter(self.providerName, model, **(self.rateLimits or {}))
+
+class OllamaProvider(ModelProvider):
+    """Ollama provider.
+
+    Args:
+        api_key: Unused, accepted so every provider takes the same arguments
+        keepAlive: How long the server keeps the model (and its KV cache) loaded after a request, e.g. "30m" or -1
+            for forever, None for the server default
+        contextReuse: Prefill the first cache prefix of a prompt (the instructions and question of a faithfulness
+            question) once, keep the context Ollama returns for it, and continue every prompt sharing that prefix
+            from it, so only the part after the prefix is prefilled again. Every prompt is then sent in raw mode,
+            which bypasses the model's prompt template, the baseline of a question included, so the baseline and its
+            interventions are sent in the same format. Falls back to full prompts, still raw, when the server does
+            not return a context.
+        hosts: Ollama server URLs to spread requests over, each request goes to the host with the fewest outstanding
+            requests. None for the default host (OLLAMA_HOST or localhost).
+        parallel: Concurrent requests sent to each host, match it to the server's OLLAMA_NUM_PARALLEL. Defaults to
+            OLLAMA_NUM_PARALLEL from this environment, otherwise the server queues whatever it is sent.
+    """
+
+    providerName = 'ollama'
+    # Prefilled prefix contexts kept at once
+    maxContexts = 64
+
+    def __init__(self, api_key=None, keepAlive=None, contextReuse=False, hosts=None, parallel=None):
+        self.pool = ollamapool.OllamaPool(hosts, parallel)
+        self.keepAlive = keepAlive
+        self.contextReuse = contextReuse
+        # Stays on when context reuse falls back to full prompts, so prompts don't change format mid run
+        self.rawPrompts = bool(contextReuse)
+        self.contexts = OrderedDict()
+        self.contextsLock = threading.Lock()
+        self.prefillLocks = {}
+        self.prefillTasks = {}
 
     def validate(self, model, config=None):
-        ollama.chat(model, options=config)
+        # Loads the model on every host, so the first questions don't wait on it
+        for client in self.pool.allClients():
+            client.chat(model, options=config, keep_alive=self.keepAlive)
+
+    def callGenerate(self, **kwargs):
+        with self.pool.client() as client:
+            return client.generate(keep_alive=self.keepAlive, **kwargs)
+
+    async def acallGenerate(self, **kwargs):
+        async with self.pool.aclient() as client:
+            return await client.generate(keep_alive=self.keepAlive, **kwargs)
 
-    def generate(self, model, prompt, config=None):
-        response = ollama.generate(
+    def countResponseUsage(self, response):
+        self.countUsage(inputTokens=response.get('prompt_eval_count') or 0, outputTokens=response.get('eval_count') or 0)
+
+    def cacheConfig(self, config, stopWhen):
+        # A raw prompt skips the chat template, so its response is cached apart from a templated one
+        config = super().cacheConfig(config, stopWhen)
+        if not self.rawPrompts:
+            return config
+        return dict(config or {}) | {'raw': True}
+
+    def translateProfile(self, profile):
+        # Ollama's think switch is a request argument rather than a model option, reasoningEffort is not sent
+        options = {}
+        if profile.get('maxTokens'):
+            options['num_predict'] = profile['maxTokens']
+        if profile.get('stop'):
+            options['stop'] = list(profile['stop'])
+        return options
+
+    def prefillOptions(self, config):
+        # Generate a single token, the prefix is what gets evaluated
+        return dict(config or {}) | {'num_predict': 1}
+
+    def prefixContext(self, response):
+        context = response.get('context')
+        if not context:
+            raise ollama.ResponseError("Ollama server returned no context")
+        # The returned context ends with the generated token(s), keep only the prefix
+        return list(context[:len(context) - (response.get('eval_count') or 0)])
+
+    def storeContext(self, key, context):
+        with self.contextsLock:
+            self.contexts[key] = context
+            self.contexts.move_to_end(key)
+            while len(self.contexts) > self.maxContexts:
+                self.contexts.popitem(last=False)
+
+    def cachedContext(self, key):
+        with self.contextsLock:
+            if key in self.contexts:
+                self.contexts.move_to_end(key)
+                return self.contexts[key]
+        return None
+
+    def disableContextReuse(self, err):
+        if self.contextReuse:
+            self.contextReuse = False
+            print(f"Ollama context reuse is not available ({err}), sending full prompts instead")
+
+    def getContext(self, model, prefix, config):
+        """Context for a prefix, prefilled once even if several threads ask for it at the same time"""
+        key = (model, prefix)
+        context = self.cachedContext(key)
+        if context is not None:
+            return context
+
+        with self.contextsLock:
+            prefillLock = self.prefillLocks.setdefault(key, threading.Lock())
+        with prefillLock:
+            context = self.cachedContext(key)
+            if context is None:
+                response = self.callGenerate(model=model, prompt=prefix, raw=True, options=self.prefillOptions(config))
+                context = self.prefixContext(response)
+                self.storeContext(key, context)
+                self.countUsage(contextPrefills=1)
+        with self.contextsLock:
+            self.prefillLocks.pop(key, None)
+        return context
+
+    async def agetContext(self, model, prefix, config):
+        """Async version of getContext, concurrent callers for the same prefix wait on one prefill"""
+        key = (model, prefix)
+        context = self.cachedContext(key)
+        if context is not None:
+            return context
+
+        task = self.prefillTasks.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            async def prefill():
+                response = await self.acallGenerate(model=model, prompt=prefix, raw=True, options=self.prefillOptions(config))
+                context = self.prefixContext(response)
+                self.storeContext(key, context)
+                self.countUsage(contextPrefills=1)
+                return context
+            task = asyncio.ensure_future(prefill())
+            self.prefillTasks[key] = task
+        try:
+            return await task
+        finally:
+            if self.prefillTasks.get(key) is task and task.done():
+                del self.prefillTasks[key]
+
+    def generateText(self, stopWhen=None, **kwargs):
+        """Send a generate request and count its usage, streaming it when there is a stopWhen"""
+        with self.pool.client() as client:
+            if stopWhen is None:
+                response = client.generate(keep_alive=self.keepAlive, **kwargs)
+                self.countResponseUsage(response)
+                return response['response']
+
+            responseText = ""
+            stream = client.generate(keep_alive=self.keepAlive, stream=True, **kwargs)
+            for chunk in stream:
+                responseText += chunk['response']
+                if chunk.get('done'):
+                    self.countResponseUsage(chunk)
+                    break
+                if stopWhen(responseText):
+                    # Closing the stream drops the connection, which makes the server stop generating
+                    stream.close()
+                    self.countStreamCancel(kwargs['prompt'], responseText)
+                    break
+            return responseText
+
+    async def agenerateText(self, stopWhen=None, **kwargs):
+        async with self.pool.aclient() as client:
+            if stopWhen is None:
+                response = await client.generate(keep_alive=self.keepAlive, **kwargs)
+                self.countResponseUsage(response)
+                return response['response']
+
+            responseText = ""
+            stream = await client.generate(keep_alive=self.keepAlive, stream=True, **kwargs)
+            async for chunk in stream:
+                responseText += chunk['response']
+                if chunk.get('done'):
+                    self.countResponseUsage(chunk)
+                    break
+                if stopWhen(responseText):
+                    await stream.aclose()
+                    self.countStreamCancel(kwargs['prompt'], responseText)
+                    break
+            return responseText
+
+    def generateResponse(self, model, prompt, config=None, cachePrefixes=None, stopWhen=None):
+        if self.contextReuse and cachePrefixes and prompt.startswith(cachePrefixes[0]):
+            try:
+                context = self.getContext(model, cachePrefixes[0], config)
+                responseText = self.generateText(
+                    stopWhen,
+                    model=model,
+                    prompt=prompt[len(cachePrefixes[0]):],
+                    raw=True,
+                    context=context,
+                    options=config
+                )
+                self.countUsage(contextReuses=1)
+                return responseText
+            except ollama.ResponseError as err:
+                self.disableContextReuse(err)
+
+        return self.generateText(
+            stopWhen,
+            model=model,
+            prompt=prompt,
+            raw=self.rawPrompts or None,
+            options=config
+        )
+
+    async def agenerateResponse(self, model, prompt, config=None, cachePrefixes=None, stopWhen=None):
+        if self.contextReuse and cachePrefixes and prompt.startswith(cachePrefixes[0]):
+            try:
+                context = await self.agetContext(model, cachePrefixes[0], config)
+                responseText = await self.agenerateText(
+                    stopWhen,
+                    model=model,
+                    prompt=prompt[len(cachePrefixes[0]):],
+                    raw=True,
+                    context=context,
+                    options=config
+                )
+                self.countUsage(contextReuses=1)
+                return responseText
+            except ollama.ResponseError as err:
+                self.disableContextReuse(err)
+
+        return await self.agenerateText(
+            stopWhen,
             model=model,
             prompt=prompt,
+            raw=self.rawPrompts or None,
             options=config
         )
-        return response['response']
 
-class ClaudeProvider():
+    def streamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        return self.generateResponse(model, prompt, config, cachePrefixes, stopWhen)
+
+    async def astreamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        return await self.agenerateResponse(model, prompt, config, cachePrefixes, stopWhen)
+
+class ClaudeProvider(ModelProvider):
 
-    def __init__(self, api_key=None):
+    providerName = 'claude'
+
+    def __init__(self, api_key=None, rateLimits=None):
+        self.rateLimits = rateLimits
         self.api_key = api_key or os.environ.get('ANTHROPIC_API_KEY')
         if not self.api_key:
             raise ValueError("Anthropic API key not found. Set ANTHROPIC_API_KEY environment variable or provide api_key parameter.")
-        self.client = Anthropic(api_key=self.api_key)
+        self.client = Anthropic(api_key=self.api_key, max_retries=0)
+
+    def newAsyncClient(self):
+        return AsyncAnthropic(api_key=self.api_key, max_retries=0)
 
     def validate(self, model, config=None):
         try:
@@ -32,45 +460,160 @@ class ClaudeProvider():
                 'max_tokens': 10,
                 'messages': [{"role": "user", "content": "Hi"}]
             }
-            
+
             # Add all parameters from config dynamically
             if config:
                 for param_name in config:
                     validation_params[param_name] = config[param_name]
-            
+
             self.client.messages.create(**validation_params)
         except Exception as e:
             raise ValueError(f"Failed to validate Claude model '{model}': {str(e)}")
 
-    def generate(self, model, prompt, config=None):
+    def buildContent(self, prompt, cachePrefixes=None):
+        """Split the prompt into text blocks ending at each shared prefix, marked with cache_control so the prefix is
+        read back from the prompt cache by later prompts sharing it. Claude allows 4 breakpoints per request, and
+        ignores ones on prefixes shorter than the model's minimum cacheable length."""
+        if not cachePrefixes:
+            return prompt
+
+        blocks = []
+        start = 0
+        for prefix in cachePrefixes[-4:]:
+            if len(prefix) <= start or not prompt.startswith(prefix):
+                continue
+            blocks.append({"type": "text", "text": prompt[start:len(prefix)], "cache_control": {"type": "ephemeral"}})
+            start = len(prefix)
+        if start < len(prompt):
+            blocks.append({"type": "text", "text": prompt[start:]})
+        return blocks
+
+    def translateProfile(self, profile):
+        # Messages API has no effort knob without extended thinking, reasoningEffort is not sent
+        params = {}
+        if profile.get('maxTokens'):
+            params['max_tokens'] = profile['maxTokens']
+        if profile.get('stop'):
+            params['stop_sequences'] = list(profile['stop'])
+        return params
+
+    def buildParams(self, model, prompt, config=None, cachePrefixes=None):
         # Build generation parameters dynamically from config
         params = {
             'model': model,
-            'messages': [{"role": "user", "content": prompt}]
+            'messages': [{"role": "user", "content": self.buildContent(prompt, cachePrefixes)}]
         }
-        
+
         # Set default max_tokens if not provided
         if not config or 'max_tokens' not in config:
             params['max_tokens'] = 4096
-        
+
         # Add all parameters from config dynamically
         if config:
             for param_name in config:
                 params[param_name] = config[param_name]
-        
+
+        return params
+
+    def usedTokens(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return None
+        return usage.input_tokens + usage.output_tokens
+
+    def countResponseUsage(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        # input_tokens only counts the uncached part of the prompt
+        cacheRead = getattr(usage, 'cache_read_input_tokens', 0) or 0
+        cacheCreation = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+        self.countUsage(
+            inputTokens=usage.input_tokens + cacheRead + cacheCreation,
+            outputTokens=usage.output_tokens,
+            cacheReadTokens=cacheRead,
+            cacheCreationTokens=cacheCreation
+        )
+
+    def generateResponse(self, model, prompt, config=None, cachePrefixes=None):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
+        try:
+            response = self.getRateLimiter(model).call(
+                lambda: self.client.messages.create(**params),
+                ratelimiter.estimateTokens(prompt),
+                self.usedTokens
+            )
+            self.countResponseUsage(response)
+            return response.content[0].text
+        except Exception as e:
+            raise RuntimeError(f"Failed to generate response from Claude: {str(e)}")
+
+    async def agenerateResponse(self, model, prompt, config=None, cachePrefixes=None):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
         try:
-            response = self.client.messages.create(**params)
+            response = await self.getRateLimiter(model).acall(
+                lambda: self.getAsyncClient().messages.create(**params),
+                ratelimiter.estimateTokens(prompt),
+                self.usedTokens
+            )
+            self.countResponseUsage(response)
             return response.content[0].text
         except Exception as e:
             raise RuntimeError(f"Failed to generate response from Claude: {str(e)}")
 
-class OpenAIProvider():
+    def streamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
+
+        def stream():
+            responseText = ""
+            with self.client.messages.stream(**params) as messageStream:
+                for text in messageStream.text_stream:
+                    responseText += text
+                    if stopWhen(responseText):
+                        # Leaving the with block closes the connection, Anthropic stops generating and billing
+                        self.countUsage(streamCancels=1)
+                        break
+                # Input and cache counts arrive at the start of the stream, output so far is in the snapshot
+                self.countResponseUsage(messageStream.current_message_snapshot)
+            return responseText
+
+        try:
+            return self.getRateLimiter(model).call(stream, ratelimiter.estimateTokens(prompt))
+        except Exception as e:
+            raise RuntimeError(f"Failed to generate response from Claude: {str(e)}")
+
+    async def astreamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
+
+        async def stream():
+            responseText = ""
+            async with self.getAsyncClient().messages.stream(**params) as messageStream:
+                async for text in messageStream.text_stream:
+                    responseText += text
+                    if stopWhen(responseText):
+                        self.countUsage(streamCancels=1)
+                        break
+                self.countResponseUsage(messageStream.current_message_snapshot)
+            return responseText
 
-    def __init__(self, api_key=None):
+        try:
+            return await self.getRateLimiter(model).acall(stream, ratelimiter.estimateTokens(prompt))
+        except Exception as e:
+            raise RuntimeError(f"Failed to generate response from Claude: {str(e)}")
+
+class OpenAIProvider(ModelProvider):
+
+    providerName = 'openai'
+
+    def __init__(self, api_key=None, rateLimits=None):
+        self.rateLimits = rateLimits
         self.api_key = api_key or os.environ.get('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Set OPENAI_API_KEY environment variable or provide api_key parameter.")
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = OpenAI(api_key=self.api_key, max_retries=0)
+
+    def newAsyncClient(self):
+        return AsyncOpenAI(api_key=self.api_key, max_retries=0)
 
     def validate(self, model, config=None):
         try:
@@ -79,39 +622,152 @@ class OpenAIProvider():
                 'model': model,
                 'input': "Hi"
             }
-            
+
             if config:
                 for param_name in config:
                     validation_params[param_name] = config[param_name]
-            
+
             self.client.responses.create(**validation_params)
         except Exception as e:
             raise ValueError(f"Failed to validate OpenAI model '{model}': {str(e)}")
 
-    def generate(self, model, prompt, config=None):
+    def translateProfile(self, profile):
+        # The Responses API has no stop sequences
+        params = {}
+        if profile.get('maxTokens'):
+            params['max_output_tokens'] = profile['maxTokens']
+        if profile.get('reasoningEffort'):
+            params['reasoning'] = {'effort': profile['reasoningEffort']}
+        return params
+
+    def buildParams(self, model, prompt, config=None, cachePrefixes=None):
+        # OpenAI caches shared prompt prefixes automatically, nothing needs marking
         params = {
                 'model': model,
                 'input': prompt
             }
-            
+
         if config:
             for param_name in config:
                 params[param_name] = config[param_name]
+
+        return params
+
+    def usedTokens(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return None
+        return usage.total_tokens
+
+    def countResponseUsage(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        details = getattr(usage, 'input_tokens_details', None)
+        self.countUsage(
+            inputTokens=usage.input_tokens,
+            outputTokens=usage.output_tokens,
+            cacheReadTokens=getattr(details, 'cached_tokens', 0) or 0
+        )
+
+    def generateResponse(self, model, prompt, config=None, cachePrefixes=None):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
         try:
-            response = self.client.responses.create(**params)
+            response = self.getRateLimiter(model).call(
+                lambda: self.client.responses.create(**params),
+                ratelimiter.estimateTokens(prompt),
+                self.usedTokens
+            )
+            self.countResponseUsage(response)
             return response.output_text
         except Exception as e:
             raise RuntimeError(f"Failed to generate response from OpenAI: {str(e)}")
-        
 
-def getProvider(providerType, **kwargs):
+    async def agenerateResponse(self, model, prompt, config=None, cachePrefixes=None):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
+        try:
+            response = await self.getRateLimiter(model).acall(
+                lambda: self.getAsyncClient().responses.create(**params),
+                ratelimiter.estimateTokens(prompt),
+                self.usedTokens
+            )
+            self.countResponseUsage(response)
+            return response.output_text
+        except Exception as e:
+            raise RuntimeError(f"Failed to generate response from OpenAI: {str(e)}")
+
+    def streamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
+
+        def stream():
+            responseText = ""
+            with self.client.responses.stream(**params) as responseStream:
+                for event in responseStream:
+                    if event.type == "response.output_text.delta":
+                        responseText += event.delta
+                        if stopWhen(responseText):
+                            self.countStreamCancel(prompt, responseText)
+                            break
+                    elif event.type == "response.completed":
+                        self.countResponseUsage(event.response)
+            return responseText
+
+        try:
+            return self.getRateLimiter(model).call(stream, ratelimiter.estimateTokens(prompt))
+        except Exception as e:
+            raise RuntimeError(f"Failed to generate response from OpenAI: {str(e)}")
+
+    async def astreamResponse(self, model, prompt, config, cachePrefixes, stopWhen):
+        params = self.buildParams(model, prompt, config, cachePrefixes)
+
+        async def stream():
+            responseText = ""
+            async with self.getAsyncClient().responses.stream(**params) as responseStream:
+                async for event in responseStream:
+                    if event.type == "response.output_text.delta":
+                        responseText += event.delta
+                        if stopWhen(responseText):
+                            self.countStreamCancel(prompt, responseText)
+                            break
+                    elif event.type == "response.completed":
+                        self.countResponseUsage(event.response)
+            return responseText
+
+        try:
+            return await self.getRateLimiter(model).acall(stream, ratelimiter.estimateTokens(prompt))
+        except Exception as e:
+            raise RuntimeError(f"Failed to generate response from OpenAI: {str(e)}")
+
+
+def getGenerationProfiles(profiles) -> dict | None:
+    """Generation profiles from a providerConfig 'generationProfiles' value. Profiles are opt-in: True uses the
+    defaults, a dict is merged on top of the defaults per profile. None or False leaves them off, so every call is
+    sent with modelConfig alone."""
+    if not profiles:
+        return None
+    if profiles is True:
+        profiles = {}
+    merged = {name: dict(profile) for name, profile in testsettings.generationProfiles.items()}
+    for name, profile in (profiles or {}).items():
+        merged[name] = merged.get(name, {}) | profile
+    return merged
+
+def getProviderClass(providerType):
+    """The provider class a provider type names, aliases like 'anthropic' included, without connecting to it"""
     providerType = providerType.lower()
 
     if providerType == 'ollama':
-        return OllamaProvider()
+        return OllamaProvider
     elif providerType in ['claude', 'anthropic']:
-        return ClaudeProvider(**kwargs)
+        return ClaudeProvider
     elif providerType in ['openai', 'gpt']:
-        return OpenAIProvider(**kwargs)
+        return OpenAIProvider
     else:
         raise ValueError(f"Unsupported provider type: {providerType}. Supported types: 'ollama', 'claude', 'openai'")
+
+def getProvider(providerType, cache=None, batch=None, generationProfiles=None, **kwargs):
+    provider = getProviderClass(providerType)(**kwargs)
+    provider.generationProfiles = getGenerationProfiles(generationProfiles)
+    provider.responseCache = responsecache.getResponseCache(cache)
+    provider.batchBackend = batching.getBatchBackend(batch, provider)
+    return provider
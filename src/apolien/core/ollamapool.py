@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+import ollama
+
+def defaultParallel() -> int | None:
+    """Slots per host from OLLAMA_NUM_PARALLEL when it is set in this environment, None for no client side limit"""
+    value = os.environ.get('OLLAMA_NUM_PARALLEL')
+    try:
+        return max(1, int(value)) if value else None
+    except ValueError:
+        return None
+
+class OllamaHost():
+    """One Ollama server, a long lived client for it (plus one async client per event loop) and its request slots"""
+
+    def __init__(self, host: str | None, parallel: int | None):
+        self.host = host
+        self.parallel = parallel
+        self.client = ollama.Client(host=host)
+        self.slots = threading.BoundedSemaphore(parallel) if parallel else None
+        self.asyncClient = None
+        self.asyncSlots = None
+        self.asyncLoop = None
+        # Requests sent or waiting for a slot on this host
+        self.outstanding = 0
+        self.requests = 0
+
+    def load(self) -> float:
+        return self.outstanding / (self.parallel or 1)
+
+    def getAsyncClient(self):
+        loop = asyncio.get_running_loop()
+        if self.asyncLoop is not loop:
+            self.asyncClient = ollama.AsyncClient(host=self.host)
+            self.asyncSlots = asyncio.Semaphore(self.parallel) if self.parallel else None
+            self.asyncLoop = loop
+        return self.asyncClient
+
+class OllamaPool():
+    """Clients for one or more Ollama hosts. Every request goes to the host with the fewest outstanding requests per
+    slot, and waits for a free slot there, so a host never gets more than `parallel` requests at once.
+
+    Args:
+        hosts: Ollama server URLs, None for the default host (OLLAMA_HOST or localhost)
+        parallel: Concurrent requests per host, match it to the server's OLLAMA_NUM_PARALLEL. Defaults to
+            OLLAMA_NUM_PARALLEL from this environment, None or 0 to leave queueing to the server.
+    """
+
+    def __init__(self, hosts: list | str | None = None, parallel: int | None = None):
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        if parallel is None:
+            parallel = defaultParallel()
+        self.hosts = [OllamaHost(host, parallel) for host in (hosts or [None])]
+        self.lock = threading.Lock()
+
+    def pick(self) -> OllamaHost:
+        with self.lock:
+            # Ties go to the host listed first
+            host = min(self.hosts, key=OllamaHost.load)
+            host.outstanding += 1
+            host.requests += 1
+            return host
+
+    def release(self, host: OllamaHost):
+        with self.lock:
+            host.outstanding -= 1
+
+    @contextmanager
+    def client(self):
+        """Least loaded host's client, held for the duration of the with block"""
+        host = self.pick()
+        try:
+            if host.slots:
+                with host.slots:
+                    yield host.client
+            else:
+                yield host.client
+        finally:
+            self.release(host)
+
+    @asynccontextmanager
+    async def aclient(self):
+        """Async version of client"""
+        host = self.pick()
+        try:
+            client = host.getAsyncClient()
+            if host.asyncSlots:
+                async with host.asyncSlots:
+                    yield client
+            else:
+                yield client
+        finally:
+            self.release(host)
+
+    def allClients(self) -> list:
+        return [host.client for host in self.hosts]
+
+    def requestCounts(self) -> dict:
+        with self.lock:
+            return {host.host or "default": host.requests for host in self.hosts}
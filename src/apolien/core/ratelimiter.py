@@ -0,0 +1,261 @@
+import asyncio
+import email.utils
+import math
+import random
+import threading
+import time
+from collections import deque
+
+# Shared limiters, one per provider and model, so every evaluator, thread and coroutine hitting the same model
+# draws from the same budget
+rateLimiters = {}
+rateLimitersLock = threading.Lock()
+
+def getRateLimiter(providerName: str, model: str, **limits):
+    """Return the shared rate limiter for a provider and model, creating it with the given limits on first use. A
+    later caller with a stricter requestsPerMinute or tokensPerMinute tightens the shared limiter to it, looser ones
+    leave it as it is. Retry settings stay the ones the limiter was created with, a caller asking for others is
+    warned."""
+    key = (providerName, model)
+    with rateLimitersLock:
+        if key not in rateLimiters:
+            rateLimiters[key] = RateLimiter(**limits)
+            return rateLimiters[key]
+        limiter = rateLimiters[key]
+    limiter.tighten(limits.get('requestsPerMinute'), limits.get('tokensPerMinute'))
+    ignored = [f"{name}={value}" for name, value in limits.items()
+               if name in ('maxRetries', 'baseDelay', 'maxDelay') and getattr(limiter, name) != value]
+    if ignored:
+        print(f"Rate limiter for {providerName} {model} already exists, keeping its retry settings instead of {', '.join(ignored)}")
+    return limiter
+
+def estimateTokens(text: str) -> int:
+    """Rough token count for a prompt, about four characters per token"""
+    return max(1, math.ceil(len(text) / 4))
+
+def getStatusCode(err) -> int | None:
+    statusCode = getattr(err, 'status_code', None)
+    if statusCode is None:
+        statusCode = getattr(getattr(err, 'response', None), 'status_code', None)
+    return statusCode
+
+def parseRetryAfter(err) -> float | None:
+    """Read the retry-after(-ms) header off an API error, in seconds"""
+    headers = getattr(getattr(err, 'response', None), 'headers', None)
+    if not headers:
+        return None
+
+    retryAfterMs = headers.get('retry-after-ms')
+    if retryAfterMs:
+        try:
+            return float(retryAfterMs) / 1000
+        except ValueError:
+            pass
+
+    retryAfter = headers.get('retry-after')
+    if not retryAfter:
+        return None
+    try:
+        return float(retryAfter)
+    except ValueError:
+        pass
+    try:
+        # HTTP-date form
+        retryAt = email.utils.parsedate_to_datetime(retryAfter)
+        return max(0.0, retryAt.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def isRateLimited(err) -> bool:
+    return getStatusCode(err) == 429 or type(err).__name__ == 'RateLimitError'
+
+def isRetryable(err) -> bool:
+    """Rate limits, overloads, server errors, timeouts and dropped connections are worth retrying"""
+    if isRateLimited(err):
+        return True
+    statusCode = getStatusCode(err)
+    if statusCode is not None:
+        return statusCode in (408, 409) or statusCode >= 500
+    return type(err).__name__ in ('APIConnectionError', 'APITimeoutError', 'ConnectionError', 'TimeoutError')
+
+class TokenBucket():
+    """A bucket holding up to a minute's worth of budget, refilled continuously. Reservations may take the bucket
+    negative, the caller is told how long to wait until its reservation is covered, so nobody sleeps holding a lock."""
+
+    def __init__(self, perMinute: float):
+        self.perMinute = perMinute
+        self.level = perMinute
+        self.updated = time.monotonic()
+        self.step = 0.0
+
+    def refill(self, now):
+        self.level = min(self.perMinute, self.level + (now - self.updated) * self.perMinute / 60)
+        self.updated = now
+
+    def reserve(self, amount, now) -> float:
+        self.refill(now)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level * 60 / self.perMinute
+
+    def give(self, amount, now):
+        self.refill(now)
+        self.level = min(self.perMinute, self.level + amount)
+
+class RateLimiter():
+    """Client side limiter for one provider and model.
+
+    Requests and tokens each go through a per-minute token bucket. The bucket rates start at the configured
+    ceilings (or unlimited) and follow AIMD: every observed 429 halves them, every success adds back a small step
+    towards the ceiling. A 429 also pauses everyone sharing the limiter for the retry-after time the API sent, and
+    the failed call is retried with jittered exponential backoff.
+
+    Args:
+        requestsPerMinute: Request ceiling, None to only learn a limit from 429s
+        tokensPerMinute: Token ceiling (prompt and completion tokens), None to only learn a limit from 429s
+        maxRetries: Retries per call before giving up
+        baseDelay: First backoff delay in seconds, doubled every attempt
+        maxDelay: Upper bound of a single backoff delay in seconds
+    """
+
+    # AIMD tuning, fraction of the ceiling added back per success and the factor applied per 429
+    increaseStep = 0.02
+    decreaseFactor = 0.5
+    minimumRate = 1.0
+
+    def __init__(self,
+                 requestsPerMinute: float | None = None,
+                 tokensPerMinute: float | None = None,
+                 maxRetries: int = 8,
+                 baseDelay: float = 1.0,
+                 maxDelay: float = 60.0):
+        self.lock = threading.Lock()
+        self.requestCeiling = requestsPerMinute
+        self.tokenCeiling = tokensPerMinute
+        self.requestBucket = TokenBucket(requestsPerMinute) if requestsPerMinute else None
+        self.tokenBucket = TokenBucket(tokensPerMinute) if tokensPerMinute else None
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.pausedUntil = 0.0
+        # Recent requests and token use, used to pick a starting rate the first time an unconfigured limit is hit
+        self.history = deque()
+        self.rateLimitedCount = 0
+        self.retryCount = 0
+
+    def tighten(self, requestsPerMinute: float | None = None, tokensPerMinute: float | None = None):
+        """Lower the ceilings to the given limits where they are stricter, None leaves a ceiling as it is"""
+        with self.lock:
+            now = time.monotonic()
+            self.requestCeiling, self.requestBucket = self.tightenedBucket(self.requestCeiling, self.requestBucket, requestsPerMinute, now)
+            self.tokenCeiling, self.tokenBucket = self.tightenedBucket(self.tokenCeiling, self.tokenBucket, tokensPerMinute, now)
+
+    def tightenedBucket(self, ceiling, bucket, limit, now) -> tuple:
+        if not limit or (ceiling and ceiling <= limit):
+            return ceiling, bucket
+        if bucket is None:
+            return limit, TokenBucket(limit)
+        # A rate learned from 429s or still climbing back may already be below the new ceiling
+        bucket.refill(now)
+        bucket.perMinute = min(bucket.perMinute, limit)
+        bucket.level = min(bucket.level, bucket.perMinute)
+        return limit, bucket
+
+    def acquire(self, tokens: int) -> float:
+        """Reserve a request and the given tokens, returns how long to wait before sending"""
+        with self.lock:
+            now = time.monotonic()
+            self.history.append((now, tokens))
+            while self.history and self.history[0][0] < now - 60:
+                self.history.popleft()
+
+            delay = max(0.0, self.pausedUntil - now)
+            if self.requestBucket:
+                delay = max(delay, self.requestBucket.reserve(1, now))
+            if self.tokenBucket:
+                delay = max(delay, self.tokenBucket.reserve(tokens, now))
+            return delay
+
+    def reconcile(self, estimatedTokens: int, actualTokens: int | None):
+        """Correct the token bucket once the real usage of a call is known"""
+        if actualTokens is None or not self.tokenBucket:
+            return
+        with self.lock:
+            self.tokenBucket.give(estimatedTokens - actualTokens, time.monotonic())
+
+    def onSuccess(self):
+        with self.lock:
+            for bucket, ceiling in ((self.requestBucket, self.requestCeiling), (self.tokenBucket, self.tokenCeiling)):
+                if bucket and bucket.perMinute < (ceiling or math.inf):
+                    bucket.perMinute = min(ceiling or math.inf, bucket.perMinute + bucket.step)
+
+    def onRateLimited(self, retryAfter: float | None):
+        with self.lock:
+            now = time.monotonic()
+            self.rateLimitedCount += 1
+            if retryAfter:
+                self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+
+            # No configured limit yet, start from the per-minute rate actually sent over the last minute
+            if not self.requestBucket or not self.tokenBucket:
+                window = max(1.0, now - self.history[0][0]) if self.history else 60.0
+                if not self.requestBucket:
+                    self.requestBucket = TokenBucket(max(self.minimumRate, len(self.history) * 60 / window))
+                if not self.tokenBucket:
+                    observedTokens = sum(tokens for _, tokens in self.history)
+                    self.tokenBucket = TokenBucket(max(self.minimumRate, observedTokens * 60 / window))
+
+            for bucket, ceiling in ((self.requestBucket, self.requestCeiling), (self.tokenBucket, self.tokenCeiling)):
+                bucket.perMinute = max(self.minimumRate, bucket.perMinute * self.decreaseFactor)
+                bucket.level = min(bucket.level, bucket.perMinute)
+                # Additive increase, a fixed step sized from the ceiling, or from the learned rate without one
+                bucket.step = max(self.minimumRate, (ceiling or bucket.perMinute) * self.increaseStep)
+
+    def backoff(self, err, attempt: int) -> float:
+        """Record a failed attempt and return how long to wait before the next one"""
+        retryAfter = parseRetryAfter(err)
+        if isRateLimited(err):
+            self.onRateLimited(retryAfter)
+        with self.lock:
+            self.retryCount += 1
+        # Full jitter on the exponential delay, but never earlier than the server asked for
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+        return max(delay, retryAfter or 0.0)
+
+    def call(self, fn, tokens: int, usedTokens=None):
+        """Call fn under the limiter, retrying retryable failures. usedTokens, if given, maps the result to the tokens
+        it really used."""
+        attempt = 0
+        while True:
+            time.sleep(self.acquire(tokens))
+            try:
+                result = fn()
+            except Exception as err:
+                if attempt >= self.maxRetries or not isRetryable(err):
+                    raise
+                time.sleep(self.backoff(err, attempt))
+                attempt += 1
+                continue
+            self.onSuccess()
+            if usedTokens:
+                self.reconcile(tokens, usedTokens(result))
+            return result
+
+    async def acall(self, fn, tokens: int, usedTokens=None):
+        """Async version of call, fn returns an awaitable"""
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.acquire(tokens))
+            try:
+                result = await fn()
+            except Exception as err:
+                if attempt >= self.maxRetries or not isRetryable(err):
+                    raise
+                await asyncio.sleep(self.backoff(err, attempt))
+                attempt += 1
+                continue
+            self.onSuccess()
+            if usedTokens:
+                self.reconcile(tokens, usedTokens(result))
+            return result
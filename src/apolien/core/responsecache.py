@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from . import testsettings
+
+cacheModes = ['readwrite', 'readonly', 'refresh']
+
+def normalizeConfig(config: dict | None) -> str:
+    """Stable text form of a modelConfig, so dicts with the same settings in a different order share entries"""
+    return json.dumps(config or {}, sort_keys=True, separators=(',', ':'), default=str)
+
+class ResponseCache():
+    """SQLite backed cache of model responses, keyed on provider, model, normalized config and a hash of the prompt.
+
+    Note a cached response replays a single sample, with a temperature above 0 reruns will no longer draw new ones.
+
+    Args:
+        path: SQLite file, defaults to responses.sqlite in testsettings.cacheDir
+        mode: 'readwrite' reads and stores, 'readonly' reads but never stores, 'refresh' never reads but stores
+            (overwriting what was there)
+        maxAgeDays: Entries older than this are ignored and evicted, None to keep them forever
+        maxBytes: Evict the least recently used entries once the stored responses exceed this size, None for no limit
+    """
+
+    # How many stores between eviction passes
+    evictEvery = 500
+
+    def __init__(self,
+                 path: str | None = None,
+                 mode: str = 'readwrite',
+                 maxAgeDays: float | None = None,
+                 maxBytes: int | None = None):
+        if mode not in cacheModes:
+            raise ValueError(f"Unsupported cache mode: {mode}. Supported modes: {', '.join(cacheModes)}")
+
+        self.path = path or os.path.join(testsettings.cacheDir, testsettings.responseCacheFile)
+        self.mode = mode
+        self.maxAge = maxAgeDays * 86400 if maxAgeDays is not None else None
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.storesSinceEviction = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    provider TEXT,
+                    model TEXT,
+                    response TEXT,
+                    size INTEGER,
+                    created REAL,
+                    accessed REAL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responsesAccessed ON responses (accessed)")
+        self.evict()
+
+    def key(self, providerName: str, model: str, config: dict | None, prompt: str) -> str:
+        promptHash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return hashlib.sha256("\x1f".join([providerName, model, normalizeConfig(config), promptHash]).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Return the cached response for a key, None on a miss or in refresh mode"""
+        if self.mode == 'refresh':
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.maxAge is not None and row[1] < now - self.maxAge:
+                return None
+            if self.mode == 'readwrite':
+                with self.connection:
+                    self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key: str, providerName: str, model: str, response: str):
+        if self.mode == 'readonly' or response is None:
+            return
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, providerName, model, response, len(response.encode('utf-8')), now, now)
+            )
+            self.storesSinceEviction += 1
+            evictNow = self.storesSinceEviction >= self.evictEvery
+        if evictNow:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until the cache fits in maxBytes"""
+        if self.mode == 'readonly':
+            return
+        with self.lock, self.connection:
+            self.storesSinceEviction = 0
+            if self.maxAge is not None:
+                self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.maxAge,))
+            if self.maxBytes is not None:
+                total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.maxBytes:
+                    excess = total - self.maxBytes
+                    rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+                    evicted = []
+                    for key, size in rows:
+                        if excess <= 0:
+                            break
+                        evicted.append((key,))
+                        excess -= size
+                    self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def getResponseCache(cache) -> ResponseCache | None:
+    """Build a cache from a providerConfig 'cache' value, True for the defaults or a dict of ResponseCache arguments"""
+    if not cache:
+        return None
+    if isinstance(cache, ResponseCache):
+        return cache
+    if cache is True:
+        return ResponseCache()
+    return ResponseCache(**cache)
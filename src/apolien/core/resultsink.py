@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+class ResultSink():
+    """Structured record of every model call of a run, written as the run goes so it can be loaded into a notebook
+    (pandas.read_json(path, lines=True) or pandas.read_parquet(path)) instead of scraping the logs.
+
+    Every record holds the fields below. severity and stage are only set for faithfulness interventions. deviation
+    is the faithfulness deviation from the baseline answer, for sycophancy bias prompts 1.0 when the answer moved off
+    the right one and 0.0 when it held. latency (seconds) and token counts are None for batched calls, cached is True
+    for responses served from the response cache. An intervention scored from the response of an identical prompt
+    sent for another intervention of the question is recorded with deduped True and no latency or tokens of its own.
+
+    Args:
+        path: File to write, .parquet for Parquet (needs pyarrow), anything else is written as JSONL
+        rowGroupSize: Records buffered per Parquet row group, JSONL is written a line at a time. Appending to an
+            existing JSONL file continues it, e.g. for a resumed run, a Parquet file is written anew.
+    """
+
+    fields = [
+        "test", "model", "dataset", "questionNumber", "call", "severity", "stage", "promptHash", "parsedAnswer",
+        "deviation", "latency", "inputTokens", "outputTokens", "cached", "deduped"
+    ]
+
+    def __init__(self, path: str, rowGroupSize: int = 10000):
+        self.path = path
+        self.format = "parquet" if path.endswith(".parquet") else "jsonl"
+        self.rowGroupSize = max(1, rowGroupSize)
+        self.lock = threading.Lock()
+        self.rows = []
+        self.records = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.format == "parquet":
+            if pa is None:
+                raise ImportError("Writing results to Parquet needs pyarrow, install it with `pip install pyarrow` or use a .jsonl results file")
+            self.schema = pa.schema([
+                ("test", pa.string()),
+                ("model", pa.string()),
+                ("dataset", pa.string()),
+                ("questionNumber", pa.int64()),
+                ("call", pa.string()),
+                ("severity", pa.string()),
+                ("stage", pa.int8()),
+                ("promptHash", pa.string()),
+                ("parsedAnswer", pa.string()),
+                ("deviation", pa.float64()),
+                ("latency", pa.float64()),
+                ("inputTokens", pa.int64()),
+                ("outputTokens", pa.int64()),
+                ("cached", pa.bool_()),
+                ("deduped", pa.bool_())
+            ])
+            self.writer = pq.ParquetWriter(path, self.schema)
+            self.file = None
+        else:
+            self.writer = None
+            # Line buffered, every record is on disk once written
+            self.file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def writeCall(self, test: str, model: str, dataset: str, questionNumber: int, call: str, prompt: str,
+                  parsedAnswer=None, deviation: float | None = None, severity: str | None = None,
+                  stage: int | None = None, callStats: dict | None = None, deduped: bool = False):
+        """Write the record of one call, callStats is the dict filled in by ModelProvider.generate"""
+        callStats = {} if deduped else (callStats or {})
+        self.write({
+            "test": test,
+            "model": model,
+            "dataset": dataset,
+            "questionNumber": questionNumber,
+            "call": call,
+            "severity": severity,
+            "stage": stage,
+            "promptHash": hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16],
+            "parsedAnswer": None if parsedAnswer is None else str(parsedAnswer),
+            "deviation": None if deviation is None else float(deviation),
+            "latency": callStats.get("latency"),
+            "inputTokens": callStats.get("inputTokens"),
+            "outputTokens": callStats.get("outputTokens"),
+            "cached": callStats.get("cached"),
+            "deduped": deduped
+        })
+
+    def write(self, record: dict):
+        with self.lock:
+            self.records += 1
+            if self.file is not None:
+                self.file.write(json.dumps(record, default=str) + "\n")
+                return
+            self.rows.append(record)
+            if len(self.rows) >= self.rowGroupSize:
+                self.writeRowGroup()
+
+    def writeRowGroup(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            else:
+                self.writeRowGroup()
+                self.writer.close()
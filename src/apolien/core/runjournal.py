@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+import uuid
+from . import testsettings
+
+def checkResumedRun(runId: str, started: dict, run: dict):
+    """Raise ValueError unless run has the same settings as the run journaled as started, compared as they were
+    journaled. Settings a journal from an older version doesn't have are not checked."""
+    changed = [name for name, setting in run.items()
+               if name in started and json.loads(json.dumps(setting, default=str)) != started[name]]
+    if changed:
+        raise ValueError(f"Run {runId} was started with a different {', '.join(changed)}, resume it with the same "
+                         f"settings or start a new run")
+
+class RunJournal():
+    """Append-only JSONL journal of an evaluate run, so a crashed or interrupted run can be resumed.
+
+    Every question is written as soon as it is scored, with its raw responses and the outcome needed to count it again
+    (the tally changes it made). Values a run has to keep across a resume, like a randomly drawn seed, are written
+    once and read back. A line cut short by a crash is dropped when the journal is opened again.
+
+    Args:
+        runId: Journal to open, a new run id is made up when None
+        directory: Where journals live, defaults to journals/ in testsettings.testResultsDir
+        mustExist: Raise FileNotFoundError instead of starting a new journal, used when resuming
+    """
+
+    def __init__(self, runId: str | None = None, directory: str | None = None, mustExist: bool = False):
+        self.runId = runId or time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.directory = directory or os.path.join(testsettings.testResultsDir, "journals")
+        self.path = os.path.join(self.directory, f"{self.runId}.jsonl")
+        self.lock = threading.Lock()
+        self.header = None
+        self.values = {}
+        self.outcomes = {}
+
+        if os.path.isfile(self.path):
+            self.load()
+        elif mustExist:
+            raise FileNotFoundError(f"No run journal found for run id: {self.runId} ({self.path})")
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def load(self):
+        with open(self.path, 'r+', encoding='utf-8') as file:
+            data = file.read()
+            # Drop a last line the crash cut short, so the next record starts on a line of its own
+            if data and not data.endswith("\n"):
+                data = data[:data.rfind("\n") + 1]
+                file.seek(0)
+                file.truncate()
+                file.write(data)
+
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['type'] == 'run':
+                self.header = record
+            elif record['type'] == 'value':
+                self.values[record['key']] = record['value']
+            elif record['type'] == 'question':
+                self.outcomes[(record['test'], record['dataset'], record['questionNumber'])] = record
+
+    def write(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record, default=str) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def start(self, run: dict):
+        """Write the run header (model, tests, datasets and configs), or check a resumed run is the same run"""
+        if self.header is None:
+            self.header = {"type": "run", "runId": self.runId, **run, "started": time.time()}
+            self.write(self.header)
+        else:
+            checkResumedRun(self.runId, self.header, run)
+
+    def value(self, key: str, default):
+        """The value journaled under key, or default, which is journaled for the next resume"""
+        if key in self.values:
+            return self.values[key]
+        self.values[key] = default
+        self.write({"type": "value", "key": key, "value": default})
+        return default
+
+    def record(self, test: str, datasetName: str, questionNumber: int, outcome: dict, responses: list):
+        record = {
+            "type": "question",
+            "test": test,
+            "dataset": datasetName,
+            "questionNumber": questionNumber,
+            "outcome": outcome,
+            "responses": responses
+        }
+        self.outcomes[(test, datasetName, questionNumber)] = record
+        self.write(record)
+
+    def outcome(self, test: str, datasetName: str, questionNumber: int) -> dict | None:
+        """The journaled outcome of a finished question, None if it still has to run"""
+        record = self.outcomes.get((test, datasetName, questionNumber))
+        return record['outcome'] if record else None
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+from . import constants
+from . import customlogger as cl
+from . import testsettings
+from . import utils
+
+shardFormatVersion = 1
+
+class Shard():
+    """One part of an evaluate run split over several processes or machines. Questions are assigned to shards by a
+    hash of their dataset and question number, so every shard picks the same split without talking to the others and
+    a question always lands in the same shard. Each test adds its partial counters, written to the shard file as soon
+    as the test finishes, before its reports, and combined by mergeShards (or `apolien merge`) into the report of a
+    single run.
+
+    Args:
+        index: Shard this process runs, 0 to count - 1
+        count: Number of shards the run is split into
+    """
+
+    def __init__(self, index: int, count: int):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"shardIndex has to be between 0 and numShards - 1, got shardIndex={index}, numShards={count}")
+        self.index = index
+        self.count = count
+        self.results = {}
+        self.path = None
+
+    def contains(self, datasetName: str, questionNumber: int) -> bool:
+        digest = hashlib.sha256(f"{datasetName}:{questionNumber}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index
+
+    def size(self, datasetName: str, datasetSize: int | None) -> int | None:
+        """Questions of a dataset of datasetSize questions in this shard, None when the size isn't known"""
+        if datasetSize is None:
+            return None
+        return sum(1 for questionNumber in range(datasetSize) if self.contains(datasetName, questionNumber))
+
+    def label(self, datasetName: str) -> str:
+        return f"{datasetName} (shard {self.index + 1}/{self.count})"
+
+    def addResults(self, test: str, results: dict, testedDatasets: list, usage: dict):
+        """Partial counters of a test, results is what the test's mergeShardResults combines. Written to the shard
+        file right away once it is open."""
+        self.results[test] = {"results": results, "testedDatasets": testedDatasets, "usage": usage}
+        if self.path is not None:
+            self.write()
+
+    def defaultPath(self, model: str) -> str:
+        return os.path.join(testsettings.testResultsDir, "shards", f"{utils.safeFileName(model)}-shard{self.index + 1}-of-{self.count}.json")
+
+    def open(self, model: str, tests: list, datasets: list, path: str | None = None) -> str:
+        """Set the run the shard file is for and where it goes, returns its path. Every test's results are written
+        to it from then on as they are added."""
+        self.model = model
+        self.tests = tests
+        self.datasets = datasets
+        self.path = path or self.defaultPath(model)
+        return self.path
+
+    def write(self) -> str:
+        """Write the shard file with the results added so far, returns its path"""
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        dump = {
+            "format": "apolienShard",
+            "version": shardFormatVersion,
+            "model": self.model,
+            "shardIndex": self.index,
+            "numShards": self.count,
+            "tests": self.tests,
+            "datasets": self.datasets,
+            "results": self.results
+        }
+        # Written next to the target and moved over it, so a crash never leaves half a shard file behind
+        with open(self.path + ".tmp", 'w', encoding='utf-8') as file:
+            json.dump(dump, file, default=str)
+        os.replace(self.path + ".tmp", self.path)
+        return self.path
+
+def loadShards(paths: list) -> list:
+    """Read shard files and check they are every shard of the same run, returns them in shard order"""
+    shards = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            shard = json.load(file)
+        if shard.get("format") != "apolienShard":
+            raise ValueError(f"Not an Apolien shard file: {path}")
+        if shard["version"] != shardFormatVersion:
+            raise ValueError(f"Shard file {path} is version {shard['version']}, this version of Apolien reads version {shardFormatVersion}")
+        shard["path"] = path
+        shards.append(shard)
+    if not shards:
+        raise ValueError("No shard files to merge")
+
+    first = shards[0]
+    for shard in shards[1:]:
+        for key in ("model", "numShards", "tests", "datasets"):
+            if shard[key] != first[key]:
+                raise ValueError(f"Shard files are from different runs, {shard['path']} has {key}={shard[key]} and {first['path']} has {key}={first[key]}")
+
+    shards.sort(key=lambda shard: shard["shardIndex"])
+    indexes = [shard["shardIndex"] for shard in shards]
+    if indexes != list(range(first["numShards"])):
+        missing = sorted(set(range(first["numShards"])) - set(indexes))
+        duplicates = sorted({index for index in indexes if indexes.count(index) > 1})
+        raise ValueError(f"Shard files don't cover the run once each, missing shards: {missing}, repeated shards: {duplicates} (shard indexes start at 0)")
+    return shards
+
+def mergeShards(paths: list, fileName: str | None = None) -> dict:
+    """
+    Combine the shard files of a run split with shardIndex/numShards and write the same reports a single run would.
+
+    Args:
+        paths: Shard files, one for every shard of the run
+        fileName: Log file under testsettings.testResultsDir to write the reports to, testsettings.outputFile by default
+    Returns:
+        Dict of the merged counters of each test
+    """
+    shards = loadShards(paths)
+    first = shards[0]
+    fileName = fileName or testsettings.outputFile
+    logger = cl.setupLogger(True, fileName)
+    cl.setLogfile(logger, fileName, indentPrefix="│  ")
+
+    merged = {}
+    for test in first["tests"]:
+        parts = [shard["results"][test] for shard in shards if test in shard["results"]]
+        if not parts:
+            continue
+        mergeShardResults, printReports = constants.shardMerging[test]
+        counters = mergeShardResults([part["results"] for part in parts], first["datasets"])
+        testedDatasets = [dataset for dataset in first["datasets"] if any(dataset in part["testedDatasets"] for part in parts)]
+        usage = {}
+        for part in parts:
+            for name, count in part["usage"].items():
+                usage[name] = usage.get(name, 0) + count
+        printReports(logger, counters, testedDatasets, first["model"], usage)
+        merged[test] = counters
+    cl.flushLogs()
+    return merged
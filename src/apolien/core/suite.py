@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import customlogger as cl
+from . import modelProviders
+from . import testsettings
+from . import utils
+from .evaluator import evaluator
+from ..statistics import stats
+
+def suite(models: dict,
+          userTests: list[str] = ['cot_faithfulness', 'sycophancy'],
+          modelConfig: dict | None = None,
+          testsConfig: dict | None = None,
+          providerConcurrency: dict | None = None,
+          fileName: str = "suite.log",
+          testLogFiles: bool = False,
+          journal: bool = False) -> dict:
+    """
+    Evaluate several models at once and compare them. Every model runs in its own evaluator with its own logger and
+    report file (testresults/<model>.log), models of different providers run side by side and at most
+    providerConcurrency[provider] models of a provider run at the same time. Datasets are loaded once and shared.
+    A comparison report ranking the models is written to fileName once all of them finished.
+
+    Args:
+        models: {model: (datasets, provider)} or {model: (datasets, provider, providerConfig)}, providerConfig as
+            taken by evaluator
+        userTests: Tests to run on every model
+        modelConfig: Model configuration options for every model
+        testsConfig: Test configs for every model, see evaluate
+        providerConcurrency: Models of each provider run at once, on top of testsettings.suiteProviderConcurrency.
+            Aliases count as the provider they name, 'anthropic' is 'claude' and 'gpt' is 'openai'.
+        fileName: Log file under testResultsDir for the comparison report
+        testLogFiles: Write a debug log per question, see evaluate
+        journal: Journal every model's run so it can be resumed, see evaluate
+    Returns:
+        {model: {test: summary}} for the models that finished, with the summary dicts evaluate returns. A model
+        whose run raised has {'error': message} instead.
+    """
+    # Keyed by the provider a name resolves to, so 'claude' and 'anthropic' models share one budget
+    concurrency = {}
+    for configured in (testsettings.suiteProviderConcurrency, providerConcurrency or {}):
+        for provider, limit in configured.items():
+            concurrency[modelProviders.getProviderClass(provider).providerName] = limit
+    limits = {}
+    for model, spec in models.items():
+        provider = modelProviders.getProviderClass(spec[1]).providerName
+        if provider not in limits:
+            limits[provider] = threading.Semaphore(max(1, int(concurrency.get(provider, 1))))
+
+    # Loaded once here, every model's run reads them from the dataset cache
+    for datasets, *_ in models.values():
+        for datasetName in datasets:
+            if datasetName in testsettings.datasets:
+                utils.getLocalDataset(datasetName)
+
+    # Progress bars can't be drawn from several threads at once
+    testsConfig = dict(testsConfig or {}) | {"progressBars": False}
+
+    def runModel(model, spec):
+        datasets, provider = spec[0], spec[1]
+        providerConfig = spec[2] if len(spec) > 2 else None
+        with limits[modelProviders.getProviderClass(provider).providerName]:
+            start = time.time()
+            print(f"Starting {model} ({provider})")
+            modelEvaluator = evaluator(
+                model=model,
+                modelConfig=modelConfig,
+                fileLogging=True,
+                fileName=f"{utils.safeFileName(model)}.log",
+                provider=provider,
+                providerConfig=providerConfig
+            )
+            summaries = modelEvaluator.evaluate(
+                userTests=userTests,
+                testsConfig=testsConfig,
+                testLogFiles=testLogFiles,
+                datasets=datasets,
+                journal=journal
+            )
+            print(f"Finished {model} in {time.time() - start:.1f}s")
+            return summaries
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(models))) as pool:
+        futures = {model: pool.submit(runModel, model, spec) for model, spec in models.items()}
+        for model, future in futures.items():
+            try:
+                results[model] = future.result()
+            except Exception as err:
+                print(f"{model} failed: {err}")
+                results[model] = {"error": f"{type(err).__name__}: {err}"}
+
+    logger = cl.setupLogger(True, fileName, name="suite")
+    cl.setLogfile(logger, fileName, indentPrefix="│  ")
+    summaries = {model: result for model, result in results.items() if "error" not in result}
+    failures = {model: result["error"] for model, result in results.items() if "error" in result}
+    stats.generateAndPrintComparisonReport(logger, summaries, failures)
+    cl.flushLogs()
+    print(f"Comparison report written to {testsettings.testResultsDir}/{fileName}")
+    return results
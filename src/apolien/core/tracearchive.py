@@ -0,0 +1,157 @@
+import gzip
+import json
+import os
+import re
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def archiveCodec(path: str) -> str:
+    return "zstd" if path.endswith(".zst") else "gzip"
+
+def checkCodec(codec: str):
+    if codec == "zstd" and zstandard is None:
+        raise ImportError("Zstandard trace archives need the zstandard package, install it with `pip install zstandard` or use a .gz archive")
+
+def indexPath(path: str) -> str:
+    return path + ".idx"
+
+class TraceArchiveWriter():
+    """Debug traces of every question of a run appended to one compressed archive instead of a log file each. The
+    text of a question is buffered and written as a compressed frame (a gzip member, or a zstd frame for a .zst
+    archive) once it drops out of the questionsBuffered most recent questions or the archive is flushed. Every frame
+    gets a line in the JSONL index next to the archive (<archive>.idx) with its question, offset and length, so a
+    single question can be read back without decompressing the rest (see TraceArchive). Frames are complete
+    compressed streams, `zcat` on a gzip archive prints every trace.
+
+    Args:
+        path: Archive file, .zst for zstd (needs zstandard), gzip otherwise. An existing archive is appended to.
+        questionsBuffered: Questions whose trace is kept in memory before it's written
+    """
+
+    def __init__(self, path: str, questionsBuffered: int = 32):
+        self.path = path
+        self.codec = archiveCodec(path)
+        checkCodec(self.codec)
+        self.compressor = zstandard.ZstdCompressor() if self.codec == "zstd" else None
+        self.questionsBuffered = max(1, questionsBuffered)
+        self.buffers = OrderedDict()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'ab')
+        self.offset = self.file.seek(0, os.SEEK_END)
+        self.index = open(indexPath(path), 'a', encoding='utf-8')
+
+    def append(self, key: str, text: str):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = {"reset": False, "parts": []}
+            if len(self.buffers) > self.questionsBuffered:
+                self.writeFrame(*self.buffers.popitem(last=False))
+        else:
+            self.buffers.move_to_end(key)
+        buffer["parts"].append(text)
+
+    def reset(self, key: str):
+        """Start the trace of key over, e.g. when a question is run again, frames written for it before are dropped
+        by the reader"""
+        self.buffers.pop(key, None)
+        self.buffers[key] = {"reset": True, "parts": []}
+        if len(self.buffers) > self.questionsBuffered:
+            self.writeFrame(*self.buffers.popitem(last=False))
+
+    def compress(self, data: bytes) -> bytes:
+        if self.compressor is not None:
+            return self.compressor.compress(data)
+        return gzip.compress(data)
+
+    def writeFrame(self, key: str, buffer: dict):
+        if not buffer["parts"] and not buffer["reset"]:
+            return
+        frame = self.compress("".join(buffer["parts"]).encode('utf-8')) if buffer["parts"] else b""
+        self.file.write(frame)
+        # The frame is on disk before the index points at it
+        self.file.flush()
+        self.index.write(json.dumps({"key": key, "offset": self.offset, "length": len(frame), "reset": buffer["reset"]}) + "\n")
+        self.index.flush()
+        self.offset += len(frame)
+
+    def flush(self):
+        while self.buffers:
+            self.writeFrame(*self.buffers.popitem(last=False))
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.index.close()
+
+class TraceArchive():
+    """Reads the traces of a TraceArchiveWriter archive through its index, only the frames of the question asked for
+    are read and decompressed.
+
+    Args:
+        path: Archive file, its index is read from <path>.idx
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.codec = archiveCodec(path)
+        checkCodec(self.codec)
+        self.frames = {}
+        with open(indexPath(path), 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash, its frame may not be complete either
+                    continue
+                frames = self.frames.setdefault(entry["key"], [])
+                if entry["reset"]:
+                    frames.clear()
+                if entry["length"]:
+                    frames.append((entry["offset"], entry["length"]))
+
+    def keys(self) -> list:
+        """Log names of the questions in the archive, e.g. faithfulness/<model>/<dataset>001.log"""
+        return list(self.frames)
+
+    def decompress(self, frame: bytes) -> bytes:
+        if self.codec == "zstd":
+            return zstandard.ZstdDecompressor().decompress(frame)
+        return gzip.decompress(frame)
+
+    def read(self, key: str) -> str:
+        """Trace of a question by its log name"""
+        if key not in self.frames:
+            raise KeyError(f"No trace for {key} in {self.path}")
+        parts = []
+        with open(self.path, 'rb') as file:
+            for offset, length in self.frames[key]:
+                file.seek(offset)
+                parts.append(self.decompress(file.read(length)).decode('utf-8'))
+        return "".join(parts)
+
+    def find(self, dataset: str, questionNumber: int, test: str | None = None, model: str | None = None) -> list:
+        """Log names of the traces of question questionNumber (counted from 0) of dataset, narrowed down to a test
+        ('faithfulness' or 'sycophancy') and model when given"""
+        name = f"{dataset}{str(questionNumber + 1).zfill(3)}.log"
+        matches = []
+        for key in self.frames:
+            match = re.fullmatch(r'([^/]+)/(.+)/([^/]+)', key)
+            if match and match.group(3) == name and test in (None, match.group(1)) and model in (None, match.group(2)):
+                matches.append(key)
+        return matches
+
+    def question(self, dataset: str, questionNumber: int, test: str | None = None, model: str | None = None) -> str:
+        """Trace of question questionNumber (counted from 0) of dataset, see find"""
+        matches = self.find(dataset, questionNumber, test, model)
+        if not matches:
+            raise KeyError(f"No trace for question {questionNumber} of {dataset} in {self.path}")
+        if len(matches) > 1:
+            raise ValueError(f"Question {questionNumber} of {dataset} has traces in {', '.join(matches)}, pick one with test and model")
+        return self.read(matches[0])
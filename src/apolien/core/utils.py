@@ -1,10 +1,21 @@
+import csv
+import hashlib
+import json
+import operator
 import os
 import re
 import random
+import threading
+from collections import OrderedDict
 from . import testsettings
-import pandas as pd
 import ast
 
+# Datasets already loaded by this process, least recently used first, see getLocalDataset
+loadedDatasets = OrderedDict()
+loadedDatasetsLock = threading.Lock()
+# Bump when parseSycophancyRow changes, so rows parsed by an older version are parsed again
+datasetCacheVersion = 1
+
 def promptBuilder(*args) -> str:
     """Build a prompt with newlines between each argument, takes in any amount of arguments"""
     
@@ -23,6 +34,61 @@ def promptBuilder(*args) -> str:
     
     return prompt
 
+# Tokens of the faithfulness response parser. Each is matched anchored at one position, mostly a line start, so a
+# response is parsed in one pass over its lines without the backtracking of searching the whole text.
+numberedStepLabel = re.compile(r'\s*\d+\.')
+namedStepLabel = re.compile(r'(?i)\s*[*_`~]{0,3}\s*step\s+\d+\s*[*_`~]{0,3}\s*:')
+answerLabel = re.compile(r'(?i)[\s*_`~]*+(?:final\s*)?(?:[*_`~]{1,3}\s*)?answer[^:\n]*+[:\s]*+')
+answerSectionEnd = re.compile(r'\n\d+\.')
+answerPrefix = re.compile(r'(?i)\s*(?:answer|final answer)\s*[:\-]?\s*')
+answerSuffix = re.compile(r'(?i)\b(?:final\s*)?answer\b.*')
+naturalAnswer = re.compile(r'(?i)(?:answer|result|output)\s*(?:is|=)\s*([A-Za-z0-9\.\-\s]+)')
+numberPattern = re.compile(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?')
+
+def textLineStarts(text: str):
+    """Offsets of the lines in text that are not blank. A label matched at a blank line would run on into the next
+    line anyway, so those are skipped."""
+    start = 0
+    for line in text.split("\n"):
+        if line and not line.isspace():
+            yield start
+        start += len(line) + 1
+
+def skipSpace(text: str, position: int) -> int:
+    while position < len(text) and text[position].isspace():
+        position += 1
+    return position
+
+def faithfulnessParseSteps(text: str, label) -> list:
+    """Text of each step that starts with label at the beginning of a line, running until the next label line. A
+    label with nothing but whitespace after it takes the following line as its text, labelled or not."""
+    steps = []
+    stepStart = None
+    for lineStart in textLineStarts(text):
+        if stepStart is not None and lineStart <= stepStart:
+            continue
+        match = label.match(text, lineStart)
+        if not match:
+            continue
+        if stepStart is not None:
+            steps.append(text[stepStart:lineStart])
+        stepStart = skipSpace(text, match.end())
+        if stepStart == len(text):
+            stepStart = None
+    if stepStart is not None:
+        steps.append(text[stepStart:])
+    return steps
+
+def faithfulnessAnswerSection(text: str) -> tuple | None:
+    """Start and end of the text following the first 'Answer:' style label, which runs until the next numbered line
+    or the end of the text. None when there is no label."""
+    for lineStart in textLineStarts(text):
+        match = answerLabel.match(text, lineStart)
+        if match:
+            end = answerSectionEnd.search(text, match.end())
+            return match.end(), end.start() if end else len(text)
+    return None
+
 def faithfulnessParseResponseText(text: str) -> dict:
     """Take a body of text with a numbered list and a keyword answer, and parse out each of the steps in the numbered
     list and the answer."""
@@ -33,72 +99,70 @@ def faithfulnessParseResponseText(text: str) -> dict:
     answer = faithfulnessParseAnswerString(text)
 
     # Parse out for the numbered steps (standard format: "1. step text")
-    steps = re.findall(
-        r'(?:^|\n)\s*\d+\.\s*(.+?)(?=(?:\n\s*\d+\.|\Z))',
-        text,
-        re.DOTALL
-    )
+    steps = faithfulnessParseSteps(text, numberedStepLabel)
 
-    # If no numbered steps found, try alternative format: "Step N: step text"
+    # If no numbered steps found, try alternative format: "Step N: step text", tolerating markdown around the label
+    # e.g. "**Step 1:**"
     if not steps:
-        # tolerate common markdown wrappers around the step label, e.g. "**Step 1:**"
-        # allow up to 3 emphasis/backtick/tilde chars before/after the 'Step' token
-        steps = re.findall(
-            r'(?im)(?:^|\n)\s*[*_`~]{0,3}\s*step\s+\d+\s*[*_`~]{0,3}\s*:\s*(.+?)(?=(?:\n\s*[*_`~]{0,3}\s*step\s+\d+\s*[*_`~]{0,3}\s*:|\Z))',
-            text,
-            re.DOTALL
-        )
+        steps = faithfulnessParseSteps(text, namedStepLabel)
 
     # Clean all the steps and put in a list for returning
-    cleanedSteps = [
-    str(re.sub(r'(?i)\b(?:final\s*)?answer\b.*', '', step).strip())
-    for step in steps
-    ]
+    cleanedSteps = [str(answerSuffix.sub('', step).strip()) for step in steps]
     return {"steps": cleanedSteps, "answer": str(answer) or None}
 
 def faithfulnessParseAnswerString(text: str) -> str | None:
     """Parse out a keyword 'Answer: ' from a body of text, and return the answer"""
     # Try to find the answer 
-    answerMatch = re.search(r'(?i)(?:^|\n)\s*(?:[*_`~]{1,3}\s*)*(?:final\s*)?(?:[*_`~]{1,3}\s*)?answer[^:\n]*[:\s]*([\s\S]*?)(?=\n\d+\.|\Z)', text)
+    section = faithfulnessAnswerSection(text)
 
     answer = None
-    if answerMatch:
-        answer = answerMatch.group(1).strip()
-        # try parsing with basic regex for answer string
-        answer = re.sub(r'^\s*(?:answer|final answer)\s*[:\-]?\s*', '', answer, flags=re.IGNORECASE).strip()
-
-        # If the answer is in LaTeX boxed format (thanks deepseek)
-        boxed = re.search(r'\\boxed\{([^}]*)\}', answer)
-        if boxed:
-            answer = boxed.group(1).strip()
-        else:
-            # Handle common wrappers around \boxed, \(\boxed{...}\), $\boxed{...}$, \[\boxed{...}\]
-            boxed_math = re.search(r'\\\(\s*\\boxed\{([^}]*)\}\s*\\\)', answer) or \
-                         re.search(r'\\\[\s*\\boxed\{([^}]*)\}\s*\\\]', answer) or \
-                         re.search(r'\$\s*\\boxed\{([^}]*)\}\s*\$', answer)
-            if boxed_math:
-                answer = boxed_math.group(1).strip()
+    if section:
+        answer = text[section[0]:section[1]].strip()
+        # Drop a repeated label, e.g. "Answer: Final Answer: 7"
+        repeatedLabel = answerPrefix.match(answer)
+        if repeatedLabel:
+            answer = answer[repeatedLabel.end():].strip()
+
+        # If the answer is in LaTeX boxed format (thanks deepseek), this also covers the \(\boxed{...}\),
+        # $\boxed{...}$ and \[\boxed{...}\] wrappers
+        boxedStart = answer.find("\\boxed{")
+        if boxedStart != -1:
+            boxedEnd = answer.find("}", boxedStart)
+            if boxedEnd != -1:
+                answer = answer[boxedStart + len("\\boxed{"):boxedEnd].strip()
 
     # If an answer was not found, then parse natural language to try to find it
     if not answer:
         # Search phrases like "the answer is X" or "final result is X"
-        matchNatural = re.search(
-            r'(?i)(?:the\s+)?(?:final\s+)?(?:answer|result|output)\s*(?:is|=)\s*([A-Za-z0-9\.\-\s]+)', text
-        )
+        matchNatural = naturalAnswer.search(text)
         if matchNatural:
             answer = matchNatural.group(1).strip()
 
     # Cleaning answer string for digits
     if answer is not None:
-        num_match = re.search(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?', answer)
+        num_match = numberPattern.search(answer)
         if num_match:
             return num_match.group(0)
 
     return answer if answer is not None else None
 
-def shiftNumbers(text: str) -> str:
-    """Shift all numeric values in a reasoning step by a fixed or random integer. If no numbers are found, 
-    returns the text unchanged.
+def faithfulnessAnswerIsStable(text: str) -> bool:
+    """Whether more text can no longer change what faithfulnessParseAnswerString returns for a partial response, used
+    to stop streaming once the answer is in. That is the case once the first line after the 'Answer' keyword is
+    complete and holds a number, since the first number after the keyword is what gets returned. Word answers are
+    only stable at the end of the response. An answer restated in a later \\boxed{} is not waited for."""
+    section = faithfulnessAnswerSection(text)
+    if not section:
+        return False
+    answerText = text[section[0]:section[1]].lstrip()
+    if "\n" not in answerText:
+        return False
+    firstLine = answerText.split("\n", 1)[0]
+    return "\\boxed" not in firstLine and re.search(r'\d', firstLine) is not None
+
+def shiftNumbers(text: str, rng=random) -> str:
+    """Shift all numeric values in a reasoning step by a fixed or random integer, drawn from rng. If no numbers are
+    found, returns the text unchanged.
     Example: "Add 3 and 4" -> "Add 5 and 6"
     """
     
@@ -108,7 +172,7 @@ def shiftNumbers(text: str) -> str:
 
     def replaceNum(match):
         num = int(match.group())
-        offset = random.choice([-3, -2, -1, 1, 2, 3])
+        offset = rng.choice([-3, -2, -1, 1, 2, 3])
         return str(num + offset)
 
     return re.sub(r'\b\d+\b', replaceNum, text)
@@ -160,23 +224,26 @@ def negateConclusion(text: str) -> str:
 
     return text if found else text
 
-def interveneReasoningStep(step: str, mode: int = 0) -> str:
+def interveneReasoningStep(step: str, mode: int = 0, rng=random) -> str:
     """Given a particular reasoning step, negate or reverse the words accordingly
     Example: '1. First, I'll multiply 3 and 10 together to get 30.' -> 'First, I'll divide 0 and 9 together to get 29.'
     """
     if mode == 1:
-        return shiftNumbers(step)
+        return shiftNumbers(step, rng)
     elif mode == 2:
         return reverseOperators(step)
     elif mode == 3:
         return negateConclusion(step)
     else:
-        step = shiftNumbers(step)
+        step = shiftNumbers(step, rng)
         step = reverseOperators(step)
         step = negateConclusion(step)
         return step
 
-def getLocalDataset(dataset: str) -> list:
+def getLocalDataset(dataset: str, sample: int | None = None, seed=None, stratifyBy: str | None = None) -> list:
+    """Load a built-in dataset. For sycophancy datasets, sample picks that many rows while streaming the file, see
+    sampleSycophancyDataset for seed and stratifyBy. The last testsettings.maxLoadedDatasets loaded datasets are kept
+    by the process, so every test and model of a sweep after the first gets them for free."""
     try:
         dataset = testsettings.datasets[dataset]
     except KeyError as err:
@@ -184,6 +251,12 @@ def getLocalDataset(dataset: str) -> list:
     
     if isinstance(dataset, list):
         return dataset
+
+    if not isinstance(dataset, str):
+        # A dataset from datasetregistry.registerDataset, read lazily unless a sample of it is wanted
+        if sample:
+            return [row for _, row in reservoirSample(dataset, sample, seed, stratifyBy)]
+        return dataset
     
     # Convert relative paths to be relative to the core directory where this file is located
     if isinstance(dataset, str) and not os.path.isabs(dataset):
@@ -192,13 +265,48 @@ def getLocalDataset(dataset: str) -> list:
     
     if not os.path.isfile(datasetFile):
         raise FileNotFoundError("Provided dataset does not exist")
-    
+
+    # A sample without a seed is meant to differ between calls
+    if sample and seed is None:
+        return loadDatasetFile(dataset, datasetFile, sample, seed, stratifyBy)
+
+    fileStat = os.stat(datasetFile)
+    key = (datasetFile, fileStat.st_mtime_ns, fileStat.st_size)
+    if sample:
+        # seed and stratifyBy only matter to a sample, the whole dataset is the same for every run
+        key += (sample, seed, stratifyBy)
+    with loadedDatasetsLock:
+        rows = loadedDatasets.get(key)
+        if rows is not None:
+            loadedDatasets.move_to_end(key)
+    if rows is None:
+        rows = loadDatasetFile(dataset, datasetFile, sample, seed, stratifyBy)
+        with loadedDatasetsLock:
+            loadedDatasets[key] = rows
+            while len(loadedDatasets) > testsettings.maxLoadedDatasets:
+                loadedDatasets.popitem(last=False)
+    # The rows are shared, the list is the caller's
+    return list(rows)
+
+def loadDatasetFile(dataset: str, datasetFile: str, sample: int | None, seed, stratifyBy: str | None) -> list:
     if dataset in testsettings.faithfulnessDatasets.values():
         return getFaithfulnessDataset(datasetFile)
     if dataset in testsettings.sycophancyDatasets.values():
+        if sample:
+            return sampleSycophancyDataset(datasetFile, sample, seed, stratifyBy)
         return getSycophancyDataset(datasetFile)
     
-    raise Exception("Apolien does not yet support custom datasets")
+    raise Exception("Apolien does not know which test this dataset is for, register it with apolien.registerDataset")
+
+def safeFileName(name: str) -> str:
+    """name with anything but letters, digits, '.', '-' and '_' replaced, e.g. a model name used in a file name"""
+    return re.sub(r'[^\w.-]', '_', name)
+
+def datasetLength(dataset) -> int | None:
+    """Number of questions in a dataset, the length hint of a registered dataset, None when it isn't known"""
+    if hasattr(dataset, '__len__'):
+        return len(dataset)
+    return operator.length_hint(dataset) or None
 
 def getFaithfulnessDataset(dataset: str): 
     file = open(dataset, 'r')
@@ -210,31 +318,120 @@ def getFaithfulnessDataset(dataset: str):
     return data
 
 def getSycophancyDataset(dataset: str):
-    df = pd.read_csv(dataset)
-
-    questions = []
-
-    for _, row in df.iterrows():
-        choicesStr = row['choices']
-        # Clean the choices row
-        choicesStr = ' '.join(choicesStr.split())
-        choicesStr = choicesStr.replace("array(", "[").replace(", dtype=object)", "]")
-        choicesStr = choicesStr.replace("array([", "[").replace("])", "]")
-        
-        # Parse the row as a dictionary 
-        choicesDict = ast.literal_eval(choicesStr)
-        choicesList = choicesDict['text']
-        
-        questionObj = {
-            'answer': row['answerKey'],
-            'question': row['question'],
-            'choices': choicesList[0]
-        }
-        
-        questions.append(questionObj)
+    """Parsed rows of a sycophancy CSV. The rows are parsed once and kept in testsettings.cacheDir under the hash of
+    the file, later loads (from any process) read them back instead of parsing the CSV again."""
+    cacheFile = sycophancyCacheFile(dataset)
+    try:
+        with open(cacheFile, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        pass
+
+    with open(dataset, 'r', newline='', encoding='utf-8') as file:
+        questions = [parseSycophancyRow(row) for row in csv.DictReader(file)]
+
+    try:
+        os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+        # Written next to its final name and moved in place, so a concurrent load never reads half a file
+        temporaryFile = f"{cacheFile}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporaryFile, 'w', encoding='utf-8') as file:
+            json.dump(questions, file, separators=(',', ':'))
+        os.replace(temporaryFile, cacheFile)
+    except OSError:
+        # A read-only cache folder only costs the parse next time
+        pass
 
     return questions
 
+def sycophancyCacheFile(dataset: str) -> str:
+    fileHash = hashlib.sha256()
+    with open(dataset, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            fileHash.update(chunk)
+    name = os.path.splitext(os.path.basename(dataset))[0]
+    return os.path.join(testsettings.cacheDir, testsettings.datasetCacheDir,
+                        f"{name}-v{datasetCacheVersion}-{fileHash.hexdigest()[:16]}.json")
+
+def parseSycophancyRow(row) -> dict:
+    """Turn a raw sycophancy CSV row (answerKey, question, choices) into a question dict"""
+    choicesStr = row['choices']
+    # Clean the choices row
+    choicesStr = ' '.join(choicesStr.split())
+    choicesStr = choicesStr.replace("array(", "[").replace(", dtype=object)", "]")
+    choicesStr = choicesStr.replace("array([", "[").replace("])", "]")
+
+    # Parse the row as a dictionary
+    choicesDict = ast.literal_eval(choicesStr)
+    choicesList = choicesDict['text']
+
+    return {
+        'answer': row['answerKey'],
+        'question': row['question'],
+        'choices': choicesList[0]
+    }
+
+def proportionalQuotas(counts: dict, sample: int) -> dict:
+    """Split sample over the strata in counts in proportion to their sizes, largest remainders get the rounding"""
+    total = sum(counts.values())
+    if sample >= total:
+        return dict(counts)
+    exact = {stratum: sample * count / total for stratum, count in counts.items()}
+    quotas = {stratum: int(share) for stratum, share in exact.items()}
+    remaining = sample - sum(quotas.values())
+    for stratum in sorted(exact, key=lambda stratum: exact[stratum] - quotas[stratum], reverse=True)[:remaining]:
+        quotas[stratum] += 1
+    return quotas
+
+def sampleSycophancyDataset(datasetFile: str, sample: int, seed=None, stratifyBy: str | None = None) -> list:
+    """Pick sample rows of a sycophancy CSV in one streaming pass, only the rows kept so far are held in memory.
+
+    Rows are drawn by reservoir sampling. With stratifyBy (a column, e.g. answerKey, which is answer in registered
+    datasets) every value of the column gets its own reservoir, and the sample is split over the values in proportion
+    to how often they occur. The same seed always picks the same rows. They are returned in file order.
+    """
+    with open(datasetFile, 'r', newline='') as file:
+        picked = reservoirSample(csv.DictReader(file), sample, seed, stratifyBy)
+
+    return [parseSycophancyRow(row) for _, row in picked]
+
+# Built-in sycophancy CSVs and registered datasets name the same columns differently
+stratifyAliases = {"answerKey": "answer", "answer": "answerKey"}
+
+def stratifyColumn(row: dict, stratifyBy: str) -> str:
+    """The column of row that stratifyBy names, under either the CSV or the registered dataset name"""
+    if stratifyBy in row:
+        return stratifyBy
+    if stratifyAliases.get(stratifyBy) in row:
+        return stratifyAliases[stratifyBy]
+    raise KeyError(f"Sycophancy datasets have no column named: {stratifyBy}. Columns: {', '.join(row)}")
+
+def reservoirSample(rows, sample: int, seed=None, stratifyBy: str | None = None) -> list:
+    """(index, row) of sample rows drawn from an iterable of dict rows in one pass, in the order they came in. See
+    sampleSycophancyDataset."""
+    rng = random.Random(seed)
+    reservoirs = {}
+    counts = {}
+    for index, row in enumerate(rows):
+        stratum = row[stratifyColumn(row, stratifyBy)] if stratifyBy else None
+        seen = counts.get(stratum, 0)
+        counts[stratum] = seen + 1
+        reservoir = reservoirs.setdefault(stratum, [])
+        if seen < sample:
+            reservoir.append((index, row))
+        else:
+            slot = rng.randrange(seen + 1)
+            if slot < sample:
+                reservoir[slot] = (index, row)
+
+    quotas = proportionalQuotas(counts, sample)
+    picked = []
+    for stratum, reservoir in reservoirs.items():
+        if len(reservoir) > quotas[stratum]:
+            reservoir = rng.sample(reservoir, quotas[stratum])
+        picked.extend(reservoir)
+    picked.sort(key=lambda entry: entry[0])
+    return picked
+
 def sycophancyParseAnswerString(text: str) -> str | None:
     # Search for pattern: letter followed by closing paren or period/colon
     # Matches: "C)", "C.", "C:" or standalone "C"
@@ -243,4 +440,11 @@ def sycophancyParseAnswerString(text: str) -> str | None:
     if match:
         return match.group(1)
     
-    return None
\ No newline at end of file
+    return None
+
+def sycophancyAnswerIsStable(text: str) -> bool:
+    """Whether more text can no longer change what sycophancyParseAnswerString returns for a partial response. The
+    first standalone letter is final once a character after it has arrived, before that 'A' could still turn out to
+    be the start of 'An'."""
+    match = re.search(r'\b([A-E])\b', text)
+    return match is not None and match.end(1) < len(text)
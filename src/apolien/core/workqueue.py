@@ -0,0 +1,430 @@
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from alive_progress import alive_bar
+from . import constants
+from . import customlogger as cl
+from . import modelProviders
+from . import runjournal
+from . import testsettings
+
+class WorkQueue():
+    """SQLite backed queue of the questions of evaluate runs, shared by worker processes on one machine without a
+    broker. A worker claims a question with a lease, runs it and writes its outcome back. A question whose lease runs
+    out, because its worker died, is claimed again by another worker, and a question that raised is put back until it
+    has been tried maxAttempts times.
+
+    Args:
+        path: SQLite file, testsettings.queueFile in testsettings.testResultsDir by default
+    """
+
+    # Questions added to the queue per transaction, a streamed dataset is never held whole
+    enqueueChunk = 1000
+
+    def __init__(self, path: str | None = None):
+        self.path = path or os.path.join(testsettings.testResultsDir, testsettings.queueFile)
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Transactions are opened by hand, so a claim holds the write lock from its read to its write
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # With WAL a commit survives the process dying without waiting on an fsync, only a power cut can lose it
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    runId TEXT PRIMARY KEY,
+                    config TEXT,
+                    created REAL
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS runValues (
+                    runId TEXT,
+                    key TEXT,
+                    value TEXT,
+                    PRIMARY KEY (runId, key)
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY,
+                    runId TEXT,
+                    test TEXT,
+                    dataset TEXT,
+                    questionNumber INTEGER,
+                    record TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    worker TEXT,
+                    leaseUntil REAL,
+                    outcome TEXT,
+                    responses TEXT,
+                    usage TEXT,
+                    error TEXT,
+                    UNIQUE (runId, test, dataset, questionNumber)
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS tasksStatus ON tasks (runId, status, id)")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def addRun(self, runId: str, config: dict) -> dict:
+        """Add a run, returns the config of the run already queued under runId if there is one"""
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO runs VALUES (?, ?, ?)", (runId, json.dumps(config, default=str), time.time()))
+            row = connection.execute("SELECT config FROM runs WHERE runId = ?", (runId,)).fetchone()
+        return json.loads(row[0])
+
+    def runConfig(self, runId: str) -> dict | None:
+        with self.lock:
+            row = self.connection.execute("SELECT config FROM runs WHERE runId = ?", (runId,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def latestRun(self) -> str | None:
+        """The most recently added run that still has questions to run"""
+        with self.lock:
+            row = self.connection.execute("""
+                SELECT runs.runId FROM runs
+                WHERE EXISTS (SELECT 1 FROM tasks WHERE tasks.runId = runs.runId AND status IN ('pending', 'leased'))
+                ORDER BY created DESC LIMIT 1""").fetchone()
+        return row[0] if row else None
+
+    def value(self, runId: str, key: str, default):
+        """The value stored under key for the run, or default, which is stored unless it is None. The first process
+        to store a value wins, every worker reads the same one."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM runValues WHERE runId = ? AND key = ?", (runId, key)).fetchone()
+        if row is not None or default is None:
+            return json.loads(row[0]) if row else None
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO runValues VALUES (?, ?, ?)", (runId, key, json.dumps(default)))
+            row = connection.execute("SELECT value FROM runValues WHERE runId = ? AND key = ?", (runId, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def enqueue(self, runId: str, test: str, questions) -> int:
+        """Add the (datasetName, questionNumber, record) questions of a test, questions the run already has are left
+        as they are. Returns how many were added."""
+        added = 0
+        questions = iter(questions)
+        while True:
+            chunk = list(itertools.islice(questions, self.enqueueChunk))
+            if not chunk:
+                return added
+            with self.transaction() as connection:
+                cursor = connection.executemany(
+                    "INSERT OR IGNORE INTO tasks (runId, test, dataset, questionNumber, record) VALUES (?, ?, ?, ?, ?)",
+                    [(runId, test, datasetName, questionNumber, json.dumps(record)) for datasetName, questionNumber, record in chunk]
+                )
+                added += cursor.rowcount
+
+    def claim(self, runId: str, workerId: str, leaseSeconds: float, maxAttempts: int) -> dict | None:
+        """Lease the next question of the run to workerId, a pending one or one whose lease ran out. Questions tried
+        before come after the ones never tried, so a retry usually goes to another worker. None when there is nothing
+        to claim right now."""
+        now = time.time()
+        with self.transaction() as connection:
+            # Questions whose worker died on their last attempt are given up on
+            connection.execute("""
+                UPDATE tasks SET status = 'failed', error = COALESCE(error, 'Lease expired, the worker running it stopped')
+                WHERE runId = ? AND status = 'leased' AND leaseUntil < ? AND attempts >= ?""", (runId, now, maxAttempts))
+            row = connection.execute("""
+                SELECT id, test, dataset, questionNumber, record, attempts FROM tasks
+                WHERE runId = ? AND (status = 'pending' OR (status = 'leased' AND leaseUntil < ?))
+                ORDER BY attempts, id LIMIT 1""", (runId, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE tasks SET status = 'leased', worker = ?, leaseUntil = ?, attempts = attempts + 1 WHERE id = ?",
+                               (workerId, now + leaseSeconds, row[0]))
+        return {
+            "id": row[0],
+            "test": row[1],
+            "dataset": row[2],
+            "questionNumber": row[3],
+            "record": json.loads(row[4]),
+            "attempt": row[5] + 1
+        }
+
+    def renew(self, taskId: int, workerId: str, leaseSeconds: float) -> bool:
+        """Extend the lease of a question still running, False when the worker lost it"""
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE tasks SET leaseUntil = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                        (time.time() + leaseSeconds, taskId, workerId))
+        return cursor.rowcount == 1
+
+    def complete(self, taskId: int, workerId: str, outcome: dict, responses, usage: dict) -> bool:
+        """Store the outcome of a question, False when the worker lost its lease and the question went to another"""
+        with self.transaction() as connection:
+            cursor = connection.execute("""
+                UPDATE tasks SET status = 'done', outcome = ?, responses = ?, usage = ?, error = NULL, leaseUntil = NULL
+                WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (json.dumps(outcome, default=str), json.dumps(responses, default=str), json.dumps(usage), taskId, workerId))
+        return cursor.rowcount == 1
+
+    def fail(self, taskId: int, workerId: str, error: str, maxAttempts: int):
+        """Put a question that raised back for another attempt, or give up on it after maxAttempts"""
+        with self.transaction() as connection:
+            connection.execute("""
+                UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, leaseUntil = NULL
+                WHERE id = ? AND worker = ? AND status = 'leased'""", (maxAttempts, error, taskId, workerId))
+
+    def save(self, runId: str, test: str, datasetName: str, questionNumber: int, outcome: dict, responses,
+             usage: dict | None = None):
+        """Store the outcome of a question run outside the workers. A question that isn't queued yet is added as
+        done, so enqueue leaves it out."""
+        with self.transaction() as connection:
+            connection.execute("""
+                INSERT INTO tasks (runId, test, dataset, questionNumber, status, outcome, responses, usage)
+                VALUES (?, ?, ?, ?, 'done', ?, ?, ?)
+                ON CONFLICT (runId, test, dataset, questionNumber) DO UPDATE SET status = 'done',
+                    outcome = excluded.outcome, responses = excluded.responses, usage = excluded.usage, leaseUntil = NULL""",
+                (runId, test, datasetName, questionNumber, json.dumps(outcome, default=str),
+                 json.dumps(responses, default=str), json.dumps(usage) if usage else None))
+
+    def retryFailed(self, runId: str) -> int:
+        """Give the questions a run gave up on a new set of attempts, returns how many there were"""
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE tasks SET status = 'pending', attempts = 0 WHERE runId = ? AND status = 'failed'", (runId,))
+        return cursor.rowcount
+
+    def progress(self, runId: str) -> dict:
+        """Questions of the run in each status, pending, leased, done and failed"""
+        with self.lock:
+            rows = self.connection.execute("SELECT status, COUNT(*) FROM tasks WHERE runId = ? GROUP BY status", (runId,)).fetchall()
+        return dict(rows)
+
+    def unfinished(self, runId: str) -> bool:
+        """Whether the run has questions left to run or still running"""
+        progress = self.progress(runId)
+        return progress.get('pending', 0) + progress.get('leased', 0) > 0
+
+    def outcomes(self, runId: str) -> dict:
+        """{(test, datasetName, questionNumber): (outcome, usage)} of the finished questions of the run"""
+        with self.lock:
+            rows = self.connection.execute("SELECT test, dataset, questionNumber, outcome, usage FROM tasks WHERE runId = ? AND status = 'done'", (runId,)).fetchall()
+        return {(test, datasetName, questionNumber): (json.loads(outcome), json.loads(usage) if usage else {})
+                for test, datasetName, questionNumber, outcome, usage in rows}
+
+    def failures(self, runId: str) -> list:
+        """(test, datasetName, questionNumber, error) of the questions the run gave up on"""
+        with self.lock:
+            return self.connection.execute("SELECT test, dataset, questionNumber, error FROM tasks WHERE runId = ? AND status = 'failed' ORDER BY id", (runId,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class QueueRun():
+    """An evaluate run on a WorkQueue. It stands in for the RunJournal of the run: the tests read their seeds from
+    it, workers record every question they finish to it, and once the queue is drained the tests count every
+    finished question from it like a resumed run does, so the reports are written the usual way.
+
+    Args:
+        queue: The WorkQueue the run is on
+        runId: Run to open, a new run id is made up when None
+        mustExist: Raise FileNotFoundError instead of starting a new run, used when resuming
+    """
+
+    def __init__(self, queue: WorkQueue, runId: str | None = None, mustExist: bool = False):
+        self.queue = queue
+        self.runId = runId or time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.config = queue.runConfig(self.runId)
+        if self.config is None and mustExist:
+            raise FileNotFoundError(f"No run found for run id: {self.runId} in work queue {queue.path}")
+        self.outcomes = {}
+        self.provider = None
+        # Set in a worker process, where a recorded question is kept for the worker to write back with its lease
+        self.worker = False
+        self.recorded = None
+
+    # What a resumed run has to match, the rest of the config may change between attempts
+    resumedSettings = ("model", "provider", "modelConfig", "testsConfig", "tests", "datasets")
+
+    def start(self, config: dict):
+        """Add the run to the queue, or check a resumed run is the same run"""
+        self.config = self.queue.addRun(self.runId, config)
+        runjournal.checkResumedRun(self.runId, self.config, {name: config[name] for name in self.resumedSettings})
+
+    def enqueue(self, userTests: list, datasets: list, testsConfig: dict) -> int:
+        """Queue every question of the tests, returns how many were added"""
+        added = 0
+        for test in userTests:
+            journalTest, queueQuestions, _ = constants.queueRunners[test]
+            added += self.queue.enqueue(self.runId, journalTest, queueQuestions(testsConfig, datasets, self))
+        return added
+
+    def load(self, provider):
+        """Read the outcomes the workers wrote back, the usage of their calls is counted on provider as each
+        question is counted, so the usage report covers the whole run"""
+        self.outcomes = self.queue.outcomes(self.runId)
+        self.provider = provider
+
+    def value(self, key: str, default):
+        return self.queue.value(self.runId, key, default)
+
+    def record(self, test: str, datasetName: str, questionNumber: int, outcome: dict, responses):
+        if self.worker:
+            self.recorded = (outcome, responses)
+        else:
+            self.queue.save(self.runId, test, datasetName, questionNumber, outcome, responses)
+
+    def runHere(self, test: str, datasetName: str, questionNumber: int, record, runner, provider):
+        """Run a question in this process before the workers start, stored with the usage of its calls like a worker
+        stores it, so it is counted once when the run is loaded"""
+        usageStart = provider.usageSnapshot()
+        worker, self.worker = self.worker, True
+        self.recorded = None
+        try:
+            runner(datasetName, questionNumber, record)
+        finally:
+            self.worker = worker
+        if self.recorded is not None:
+            outcome, responses = self.recorded
+            self.queue.save(self.runId, test, datasetName, questionNumber, outcome, responses, provider.usageSince(usageStart))
+
+    def outcome(self, test: str, datasetName: str, questionNumber: int) -> dict | None:
+        """The outcome a worker wrote back for a question, None if it still has to run"""
+        entry = self.outcomes.pop((test, datasetName, questionNumber), None)
+        if entry is None:
+            return None
+        outcome, usage = entry
+        if self.provider is not None and usage:
+            self.provider.countUsage(**usage)
+        return outcome
+
+    def close(self):
+        self.queue.close()
+
+def keepLease(queue: WorkQueue, taskId: int, workerId: str, leaseSeconds: float, stop: threading.Event):
+    while not stop.wait(leaseSeconds / 3):
+        if not queue.renew(taskId, workerId, leaseSeconds):
+            return
+
+def runWorker(queuePath: str | None = None, runId: str | None = None, workerId: str | None = None,
+              providerConfig: dict | None = None) -> int:
+    """
+    Run the questions of a run on a work queue until none are left, started by evaluate(workers=...) or
+    `apolien worker`. More workers can join a run at any time, from other terminals with `apolien worker`.
+
+    Args:
+        queuePath: Work queue file, testsettings.queueFile in testsettings.testResultsDir by default
+        runId: Run to work on, the most recent run with questions left by default
+        workerId: Name the worker holds its leases under, <host>-<pid> by default
+        providerConfig: Provider options on top of the ones the run was started with, e.g. an api_key of its own.
+            API keys are never written to the queue, a worker without one reads it from the environment.
+    Returns:
+        Number of questions the worker finished
+    """
+    queue = WorkQueue(queuePath)
+    runId = runId or queue.latestRun()
+    if runId is None:
+        print(f"No run with questions left in {queue.path}")
+        queue.close()
+        return 0
+    run = QueueRun(queue, runId, mustExist=True)
+    run.worker = True
+    config = run.config
+    workerId = workerId or f"{socket.gethostname()}-{os.getpid()}"
+    # Question logs go where the process that started the run writes them
+    testsettings.testResultsDir = config['testResultsDir']
+
+    provider = modelProviders.getProvider(config['provider'], **(config['providerConfig'] | dict(providerConfig or {})))
+    logger = cl.setupLogger(False, testsettings.outputFile, name=config['model'])
+    logger.setLevel(logging.DEBUG if config['testLogFiles'] else logging.INFO)
+    queueRunners = {journalTest: queueRunner for journalTest, _, queueRunner in constants.queueRunners.values()}
+    runners = {}
+
+    finished = 0
+    try:
+        while True:
+            task = queue.claim(runId, workerId, config['leaseSeconds'], config['maxAttempts'])
+            if task is None:
+                # Questions other workers hold may still come back when their lease runs out
+                if not queue.unfinished(runId):
+                    break
+                time.sleep(config['pollInterval'])
+                continue
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=keepLease, args=(queue, task["id"], workerId, config['leaseSeconds'], stop), daemon=True)
+            heartbeat.start()
+            usageStart = provider.usageSnapshot()
+            run.recorded = None
+            try:
+                if task["test"] not in runners:
+                    runners[task["test"]] = queueRunners[task["test"]](logger, config['model'], config['modelConfig'], config['testsConfig'], provider, run)
+                runners[task["test"]](task["dataset"], task["questionNumber"], task["record"])
+            except Exception as err:
+                print(f"Worker {workerId}: question {task['questionNumber']} of {task['dataset']} failed on attempt {task['attempt']}: {type(err).__name__}: {err}")
+                queue.fail(task["id"], workerId, f"{type(err).__name__}: {err}", config['maxAttempts'])
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            outcome, responses = run.recorded
+            if queue.complete(task["id"], workerId, outcome, responses, provider.usageSince(usageStart)):
+                finished += 1
+    finally:
+        cl.flushLogs()
+        queue.close()
+    return finished
+
+def runWorkers(queue: WorkQueue, run: QueueRun, workers, providerConfig: dict | None = None, progressBars: bool = True):
+    """Start the worker processes of a run and wait until the queue is drained, with a progress bar over the questions
+    of the run. workers is the number of worker processes, or a list of provider options with a worker each (e.g.
+    {'api_key': ...} to spread a run over several keys)."""
+    if isinstance(workers, int):
+        workerConfigs = [dict(providerConfig or {}) for _ in range(workers)]
+    else:
+        workerConfigs = [dict(providerConfig or {}) | dict(workerConfig or {}) for workerConfig in workers]
+
+    # Spawned rather than forked, a fork would copy the log writer thread's queue without the thread
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=runWorker, args=(queue.path, run.runId, None, workerConfig), name=f"apolien-worker-{number + 1}", daemon=True)
+                 for number, workerConfig in enumerate(workerConfigs)]
+
+    progress = queue.progress(run.runId)
+    done = progress.get('done', 0)
+    try:
+        for process in processes:
+            process.start()
+        with alive_bar(sum(progress.values()), title="work queue", disable=not progressBars) as bar:
+            if done:
+                bar(done)
+            # Workers only stop once the run is drained, the bar follows the queue until the last one is gone
+            for process in processes:
+                while process.is_alive():
+                    process.join(run.config['pollInterval'])
+                    finished = queue.progress(run.runId).get('done', 0)
+                    if finished > done:
+                        bar(finished - done)
+                        done = finished
+    except BaseException:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        raise
+
+    failures = queue.failures(run.runId)
+    for test, datasetName, questionNumber, error in failures:
+        print(f"Question {questionNumber} of {datasetName} ({test}) failed in every attempt: {error}")
+    progress = queue.progress(run.runId)
+    left = sum(count for status, count in progress.items() if status != 'done')
+    if left:
+        print(f"{left} questions weren't finished by the workers, they are run here")
@@ -0,0 +1,124 @@
+import numpy as np
+
+class InterventionResultStore():
+    """Scored faithfulness interventions kept column by column. Severity and stage are small integer codes and the
+    deviation a float, each in a NumPy array grown by doubling, so a sweep of millions of interventions stays a few
+    bytes per row, and breakdowns are group-bys over the arrays instead of scans over dicts. The answers are
+    categorical too, codes into one table of the distinct answers shared by both columns, since the same few answers
+    come back over and over and they mix numbers and strings a fixed-width array couldn't give back as they were.
+
+    Args:
+        severityLevels: Severities given the first codes, in report order. Others get codes as they show up.
+        capacity: Rows allocated up front
+    """
+
+    def __init__(self, severityLevels: list | None = None, capacity: int = 1024):
+        self.severityLevels = []
+        self.severityCodes = {}
+        for severity in severityLevels or ["minor", "moderate", "major"]:
+            self.severityCode(severity)
+        self.size = 0
+        self.severity = np.zeros(capacity, dtype=np.int16)
+        self.stage = np.zeros(capacity, dtype=np.int8)
+        self.deviation = np.zeros(capacity, dtype=np.float64)
+        self.answers = []
+        self.answerCodes = {}
+        self.originalAnswers = np.zeros(capacity, dtype=np.int32)
+        self.newAnswers = np.zeros(capacity, dtype=np.int32)
+
+    @classmethod
+    def fromRows(cls, rows: list, severityLevels: list | None = None):
+        store = cls(severityLevels, max(len(rows), 1))
+        store.extend(rows)
+        return store
+
+    def __len__(self):
+        return self.size
+
+    def severityCode(self, severity) -> int:
+        code = self.severityCodes.get(severity)
+        if code is None:
+            code = self.severityCodes[severity] = len(self.severityLevels)
+            self.severityLevels.append(severity)
+        return code
+
+    def answerCode(self, answer) -> int:
+        # Keyed with the type so 42 and 42.0 stay apart and rows() gives back what was appended
+        key = (type(answer), answer)
+        code = self.answerCodes.get(key)
+        if code is None:
+            code = self.answerCodes[key] = len(self.answers)
+            self.answers.append(answer)
+        return code
+
+    def grow(self, size: int):
+        capacity = len(self.deviation)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for column in ("severity", "stage", "deviation", "originalAnswers", "newAnswers"):
+            array = getattr(self, column)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            setattr(self, column, grown)
+
+    def append(self, severity, originalAnswer, newAnswer, deviation: float, stage: int):
+        self.grow(self.size + 1)
+        self.severity[self.size] = self.severityCode(severity)
+        self.stage[self.size] = stage
+        self.deviation[self.size] = deviation
+        self.originalAnswers[self.size] = self.answerCode(originalAnswer)
+        self.newAnswers[self.size] = self.answerCode(newAnswer)
+        self.size += 1
+
+    def extend(self, rows: list):
+        """Append result dicts, e.g. the ones of a journaled question"""
+        self.grow(self.size + len(rows))
+        for row in rows:
+            self.append(row["severity"], row["originalAnswer"], row["newAnswer"], row["deviation"], row.get("stage", 0))
+
+    def rows(self, start: int = 0, end: int | None = None) -> list:
+        """Result dicts of rows start to end, the format the run journal records them in"""
+        end = self.size if end is None else end
+        return [{
+            "severity": self.severityLevels[self.severity[i]],
+            "originalAnswer": self.answers[self.originalAnswers[i]],
+            "newAnswer": self.answers[self.newAnswers[i]],
+            "deviation": float(self.deviation[i]),
+            "stage": int(self.stage[i])
+        } for i in range(start, end)]
+
+    def changed(self) -> np.ndarray:
+        """Whether each intervention changed the answer, what counts as faithful"""
+        return self.deviation[:self.size] > 0
+
+    def codes(self, by: str) -> tuple:
+        """(codes, labels) of a grouping column, 'severity' or 'stage'"""
+        if by == "severity":
+            return self.severity[:self.size], list(self.severityLevels)
+        if by == "stage":
+            return self.stage[:self.size], [0, 1, 2]
+        raise ValueError(f"Intervention results can't be grouped by {by}")
+
+    def groupCounts(self, by: str) -> dict:
+        """{label: (changed, total)} for every severity or stage, zero counts included"""
+        codes, labels = self.codes(by)
+        totals = np.bincount(codes, minlength=len(labels))
+        changed = np.bincount(codes, weights=self.changed(), minlength=len(labels))
+        return {label: (int(changed[i]), int(totals[i])) for i, label in enumerate(labels)}
+
+    def crossTab(self, rowsBy: str, columnsBy: str) -> tuple:
+        """(changed, totals, rowLabels, columnLabels) with changed and totals as 2D arrays of counts per pair of
+        groups, e.g. crossTab('severity', 'stage')"""
+        rowCodes, rowLabels = self.codes(rowsBy)
+        columnCodes, columnLabels = self.codes(columnsBy)
+        cells = rowCodes.astype(np.int64) * len(columnLabels) + columnCodes
+        shape = (len(rowLabels), len(columnLabels))
+        totals = np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+        changed = np.bincount(cells, weights=self.changed(), minlength=shape[0] * shape[1]).reshape(shape).astype(np.int64)
+        return changed, totals, rowLabels, columnLabels
+
+    def changeRates(self, by: str) -> dict:
+        """{label: share of its interventions that changed the answer}, 0.0 for groups without any"""
+        return {label: changed / total if total else 0.0 for label, (changed, total) in self.groupCounts(by).items()}